@@ -20,19 +20,246 @@
 __version__ = "0.2"
 
 import BaseHTTPServer
+import Queue
+import argparse
+import array
 import base64
+import bisect
+import codecs
+import collections
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import fcntl
 import getpass
+import hashlib
+import heapq
+import hmac
+import itertools
 import json
+import mmap
+import multiprocessing
 import os
+import random
 import re
+import select
+import signal
+import socket
+import sre_parse
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
 
 
 CONFIGURATION_FILENAME = '.glarkconnector.conf'
+SEARCH_INDEX_FILENAME = '.glarkconnector.index'
 CONFIG = {}
 
+# Default values of the optional settings. Any of them can be overridden in the
+# configuration file, and some of them on the command line.
+DEFAULT_SETTINGS = {
+    # How requests are served: 'single' (one request at a time), 'threaded'
+    # (bounded pool of worker threads), 'prefork' (worker processes sharing
+    # the listening socket) or 'evented' (event loop holding the idle
+    # connections, pool of worker threads serving the requests).
+    'server_mode': 'threaded',
+    # Number of worker threads or processes.
+    'workers': 8,
+    # Maximum number of requests accepted but not answered yet. Connections
+    # above this limit are answered with a 503, but in the 'prefork' mode,
+    # where it is only the size of the backlog of the listening socket.
+    'max_in_flight': 64,
+    # Seconds after which an idle connection is closed by the 'evented' mode.
+    'idle_timeout': 60,
+    # Seconds after which an idle keep-alive connection is closed by the other
+    # modes, where it holds a worker while waiting.
+    'keepalive_timeout': 5,
+    # Number of requests served on a connection before closing it.
+    'max_keepalive_requests': 100,
+    # Flush the raw uploads to the disk before answering. Can also be asked
+    # per request with the 'fsync' query parameter.
+    'fsync_uploads': False,
+    # Number of directory listings kept in memory. 0 disables the cache.
+    'listing_cache_size': 1024,
+    # Watch the served directories with inotify (Linux only) instead of
+    # checking their modification time.
+    'use_inotify': True,
+    # Maximum number of entries in a page of the tree route.
+    'tree_max_entries': 5000,
+    # Compress the responses for the clients accepting gzip or deflate.
+    'compression': True,
+    # Responses smaller than this many bytes are not worth compressing.
+    'compression_min_size': 1024,
+    # zlib compression level, from 1 (fastest) to 9 (smallest).
+    'compression_level': 6,
+    # Bytes of compressed file contents kept in memory.
+    'compressed_cache_size': 32 * 1024 * 1024,
+    # Bytes of file contents kept in memory, 0 disables the cache.
+    'content_cache_size': 64 * 1024 * 1024,
+    # Map the big files in memory rather than reading them on every request.
+    # The size of the file is checked before each block is copied from its
+    # mapping: the truncated files are read instead.
+    'content_cache_mmap': False,
+    # Gitignore style patterns of the paths hidden from the listings, such as
+    # 'node_modules/' or '*.pyc'. The ignored paths can still be accessed.
+    'ignore': [],
+    # Threads reading the files of the batch requests, apart from the ones
+    # serving the requests.
+    'batch_threads': 8,
+    # Maximum number of files in a batch request.
+    'batch_max_files': 256,
+    # Files bigger than this many bytes are not sent in a batch.
+    'batch_max_file_size': 1024 * 1024,
+    # Maximum number of bytes of file contents sent in a batch.
+    'batch_max_size': 16 * 1024 * 1024,
+    # Seconds without changes after which the pending events are sent.
+    'events_debounce': 0.1,
+    # Seconds after which the pending events are sent, even if the changes go
+    # on.
+    'events_max_delay': 1.0,
+    # Seconds between two scans of the tree, if it cannot be watched.
+    'events_poll_interval': 2,
+    # Maximum number of event streams and long polls waiting at once. They are
+    # always given less workers than there are, so that other requests are
+    # still served.
+    'events_max_streams': 4,
+    # Seconds between two keep-alive comments in the event streams.
+    'events_heartbeat': 15,
+    # Processes searching the files, apart from the ones serving the requests.
+    # 0 searches in the serving process.
+    'search_processes': 4,
+    # Maximum number of matching lines sent back by a search.
+    'search_max_results': 1000,
+    # Files bigger than this many bytes are not searched.
+    'search_max_file_size': 4 * 1024 * 1024,
+    # Keep an index of the trigrams of the files, saved in
+    # SEARCH_INDEX_FILENAME, so that the searches only read the files which may
+    # match.
+    'search_index': False,
+    # Keep an index of the paths of the files for the find route, built on the
+    # first find.
+    'find_index': True,
+    # Maximum number of paths sent back by the find route.
+    'find_max_results': 100,
+    # Time the requests and count them, for the metrics route.
+    'metrics': True,
+    # File the access log is appended to, as JSON lines, '-' for the standard
+    # error. null disables the log.
+    'access_log': '-',
+    # Fraction of the successful requests that are logged.
+    'access_log_sample_rate': 1.0,
+    # Maximum number of failed requests logged per second, the others are
+    # only counted.
+    'access_log_max_failures': 10,
+    # Failed authentications allowed in a row from a client address. Beyond,
+    # its requests get a 429 until it may try again.
+    'auth_failure_burst': 10,
+    # Failed authentications allowed per second from a client address, in the
+    # long run.
+    'auth_failure_rate': 0.5,
+    # Seconds during which the session tokens are valid.
+    'session_lifetime': 3600,
+}
+
+SERVER_MODES = ['single', 'threaded', 'prefork', 'evented']
+
 # Files that must not be displayed by the connector.
-BLACKLISTED_FILES = [os.path.basename(__file__), CONFIGURATION_FILENAME]
+BLACKLISTED_FILES = [os.path.basename(__file__), CONFIGURATION_FILENAME, SEARCH_INDEX_FILENAME]
+
+# Size of the blocks in which file contents are sent.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# File contents above this size are streamed in the jsend responses instead of
+# being read at once.
+STREAMED_CONTENT_THRESHOLD = 256 * 1024
+
+# Values that iter_json can leave to json.dumps.
+JSON_SCALAR_TYPES = (basestring, int, long, float, bool, type(None))
+
+# Permissions masked out of the files created by the connector.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Raw files above this size are sent uncompressed, as they are compressed in
+# memory.
+MAX_COMPRESSED_FILE_SIZE = 4 * 1024 * 1024
+
+# Content encodings the connector can compress responses with, by order of
+# preference.
+CONTENT_ENCODINGS = ['gzip', 'deflate']
+
+# Maximum number of seconds a long poll of the events can wait.
+MAX_EVENTS_TIMEOUT = 60
+
+# Files holding a NUL byte in their first bytes are binary, and not searched.
+BINARY_CHECK_SIZE = 8000
+
+# Matching lines are cut to this many characters in the search results.
+MAX_SEARCH_LINE_LENGTH = 500
+
+# Number of files searched or indexed by a task of the search processes.
+SEARCH_BATCH_SIZE = 16
+
+# Seconds after which a search gives up on a task of the search processes.
+SEARCH_TASK_TIMEOUT = 60
+
+# The search results are sent in blocks of this many bytes, smaller than the
+# usual ones, so that the first results are received early.
+SEARCH_RESULTS_BLOCK_SIZE = 4 * 1024
+
+# The find route only ranks this many matching paths.
+FIND_MAX_CANDIDATES = 5000
+
+# Seconds a find request waits for the index of the paths to be built.
+FIND_READY_TIMEOUT = 5
+
+# Bytes of paths matching the recent queries of the find route kept in memory.
+FIND_CACHE_SIZE = 16 * 1024 * 1024
+
+# Upper bounds, in seconds, of the buckets of the histograms of the metrics.
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Label of the route of a request path in the metrics, '/connector' being the
+# 'api' route.
+ROUTE_NAME = re.compile(r'/connector/(files|raw|tree|events|search|find|version|metrics|session|'
+                        r'batch/read|batch/write)(?:/|\Z)')
+
+# Entries of the access log waiting to be written, above which they are
+# dropped.
+ACCESS_LOG_QUEUE_SIZE = 10000
+
+# Maximum number of entries of the access log written at once.
+ACCESS_LOG_BATCH_SIZE = 256
+
+# Seconds between two reports of the entries of the access log that were
+# dropped or rate limited.
+ACCESS_LOG_REPORT_INTERVAL = 1
+
+# Iterations of PBKDF2 in the authentication_hash of the new configurations.
+PBKDF2_ITERATIONS = 100000
+
+# Number of Authorization headers known to be valid, so that their hash is not
+# checked again.
+AUTH_CACHE_SIZE = 256
+
+# Number of client addresses whose failed authentications are remembered.
+AUTH_THROTTLE_MAX_CLIENTS = 10000
+
+UNAUTHORIZED_JSEND = json.dumps({'status': 'failure', 'data': 'Unauthorized'})
+
+# Number of revoked sessions remembered until they expire, by all the
+# processes.
+SESSION_MAX_REVOKED = 4096
+
+# Unread request bodies up to this size are skipped to keep the connection
+# alive, bigger ones close the connection.
+MAX_DISCARDED_BODY_SIZE = 64 * 1024
 
 
 class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -42,6 +269,30 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     allow_origin = "http://glark.io"
     allow_origin = "*" # Allow any origin (not for production!)
 
+    # Keep the connections alive, and send the headers and small bodies in a
+    # single packet.
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    # Python 2 does not know all of the status codes sent.
+    responses = dict(BaseHTTPServer.BaseHTTPRequestHandler.responses)
+    responses[429] = ('Too Many Requests', 'The client sent too many requests.')
+
+    # Number of requests already served on the connection.
+    requests_served = 0
+
+    # Session of the request, if authenticated by a session token.
+    session = None
+
+    # Metrics and log of the request being served, see handle_one_request.
+    metrics = None
+    access_log = None
+    status_code = None
+    current_phase = None
+    # Whether the Connection header of the response was sent.
+    connection_announced = False
+
     def do_GET(self):
         """Serve a GET request."""
         # Route request.
@@ -57,6 +308,22 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         elif (re.match(r'/connector/files/(.+)$', self.path)):
             requested_file = re.match(r'/connector/files/(.+)$', self.path).group(1)
             self.route_get_file(requested_file)
+        elif (re.match(r'/connector/raw/(.+)$', self.path)):
+            requested_file = re.match(r'/connector/raw/(.+)$', self.path).group(1)
+            self.route_get_raw_file(requested_file)
+        elif (self.path == '/connector/tree'):
+            self.route_get_tree(os.getcwd())
+        elif (re.match(r'/connector/tree/(.+)$', self.path)):
+            requested_dir = re.match(r'/connector/tree/(.+)$', self.path).group(1)
+            self.route_get_tree(requested_dir)
+        elif (self.path == '/connector/events'):
+            self.route_get_events()
+        elif (self.path == '/connector/search'):
+            self.route_get_search()
+        elif (self.path == '/connector/find'):
+            self.route_get_find()
+        elif (self.path == '/connector/metrics'):
+            self.route_get_metrics()
         else:
             self.route_400()
 
@@ -70,7 +337,13 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.route_404()
         elif (re.match(r'/connector/files/(.+)$', self.path)):
             requested_file = re.match(r'/connector/files/(.+)$', self.path).group(1)
-            self.route_put_file(requested_file)
+            if self.is_raw_upload():
+                self.route_put_raw_file(requested_file)
+            else:
+                self.route_put_file(requested_file)
+        elif (re.match(r'/connector/raw/(.+)$', self.path)):
+            requested_file = re.match(r'/connector/raw/(.+)$', self.path).group(1)
+            self.route_put_raw_file(requested_file)
         else:
             self.route_400()
 
@@ -82,9 +355,44 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         if (self.path == '/connector/files'):
             self.route_404()
+        elif (self.path == '/connector/session'):
+            self.route_post_session()
+        elif (self.path == '/connector/batch/read'):
+            self.route_post_batch_read()
+        elif (self.path == '/connector/batch/write'):
+            self.route_post_batch_write()
         elif (re.match(r'/connector/files/(.+)$', self.path)):
             new_file = re.match(r'/connector/files/(.+)$', self.path).group(1)
-            self.route_post_file(new_file)
+            if self.is_raw_upload():
+                self.route_post_raw_file(new_file)
+            else:
+                self.route_post_file(new_file)
+        elif (re.match(r'/connector/raw/(.+)$', self.path)):
+            new_file = re.match(r'/connector/raw/(.+)$', self.path).group(1)
+            self.route_post_raw_file(new_file)
+        else:
+            self.route_400()
+
+    def do_PATCH(self):
+        """Serve a PATCH request."""
+        # Route request.
+        if not self.is_authenticated():
+            return
+
+        if (re.match(r'/connector/files/(.+)$', self.path)):
+            requested_file = re.match(r'/connector/files/(.+)$', self.path).group(1)
+            self.route_patch_file(requested_file)
+        else:
+            self.route_400()
+
+    def do_DELETE(self):
+        """Serve a DELETE request."""
+        # Route request.
+        if not self.is_authenticated():
+            return
+
+        if (self.path == '/connector/session'):
+            self.route_delete_session()
         else:
             self.route_400()
 
@@ -92,14 +400,171 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """Serve a OPTIONS request."""
         self.send_response(200)
         self.send_header("Access-Control-Allow-Origin", self.allow_origin)
-        self.send_header("Access-Control-Allow-Methods", "GET, PUT")
+        self.send_header("Access-Control-Allow-Methods", "GET, PUT, PATCH, DELETE")
         self.send_header("Access-Control-Allow-Headers",
-                        "accept, origin, x-requested-with, authorization, content-type")
+                        "accept, origin, x-requested-with, authorization, content-type, "
+                        "if-none-match, if-modified-since, if-range, range")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_HEAD(self):
         """Serve a HEAD request."""
-        raise NotImplementedError
+        # Route request.
+        if not self.is_authenticated():
+            return
+
+        if (self.path == '/connector/files'):
+            self.route_head_path(os.getcwd())
+        elif (re.match(r'/connector/files/(.+)$', self.path)):
+            requested_path = re.match(r'/connector/files/(.+)$', self.path).group(1)
+            self.route_head_path(requested_path)
+        elif (re.match(r'/connector/raw/(.+)$', self.path)):
+            requested_file = re.match(r'/connector/raw/(.+)$', self.path).group(1)
+            self.route_head_path(requested_file, raw=True)
+        elif (self.path == '/connector'):
+            self.route_get_api_description()
+        elif (self.path == '/connector/version'):
+            self.route_get_server_version()
+        elif (self.path == '/connector/metrics'):
+            self.route_get_metrics()
+        elif (self.path in ('/connector/tree', '/connector/events', '/connector/search', '/connector/find') or
+                re.match(r'/connector/tree/(.+)$', self.path)):
+            # Their headers cannot be known without doing all the work.
+            self.route_405('GET')
+        else:
+            self.route_400()
+
+    def parse_request(self):
+        self.request_start = time.time()
+        with self.timing('routing'):
+            if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+                return False
+            # Route on the path only, the query string holds the options of
+            # the routes.
+            self.path, _, query_string = self.path.partition('?')
+            self.query = urlparse.parse_qs(query_string, keep_blank_values=True)
+            self.route = route_name(self.path)
+        if not self.has_delimited_body():
+            # The next request of the connection could be read from the body.
+            self.close_connection = 1
+            self.route_400("invalid Content-Length or Transfer-Encoding")
+            return False
+        return True
+
+    def has_delimited_body(self):
+        """Is the end of the request body known without doubt: a chunked
+        body, or a single valid Content-Length, or no body?"""
+        content_lengths = self.headers.getheaders('content-length')
+        transfer_encoding = self.headers.getheader('transfer-encoding')
+        if transfer_encoding is not None:
+            return transfer_encoding.strip().lower() == 'chunked' and not content_lengths
+        return len(content_lengths) <= 1 and all(value.strip().isdigit() for value in content_lengths)
+
+    def setup(self):
+        if getattr(self.server, 'one_request_per_dispatch', False):
+            self.timeout = setting('idle_timeout')
+            # The connection outlives the handler between two requests.
+            self.requests_served = self.request.requests_served
+        else:
+            self.timeout = setting('keepalive_timeout')
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        if setting('metrics'):
+            self.metrics = METRICS.get()
+        self.access_log = ACCESS_LOG.get()
+        if self.metrics is not None or self.access_log is not None:
+            self.rfile = CountingFile(self.rfile)
+            self.wfile = CountingFile(self.wfile)
+
+    def finish(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        if getattr(self.server, 'one_request_per_dispatch', False):
+            self.request.requests_served = self.requests_served
+
+    def handle(self):
+        """Handle the requests of the connection.
+
+        Servers setting one_request_per_dispatch only let the handler serve a
+        single request: they take the connection back in between requests."""
+        self.close_connection = 1
+        self.handle_one_request()
+        if getattr(self.server, 'one_request_per_dispatch', False):
+            return
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait for the next request of the connection.
+
+        Return False if the connection is to be closed instead: the server
+        may need the worker serving it for another connection."""
+        wait = getattr(self.server, 'wait_for_request', None)
+        # socket._fileobject only keeps the unread bytes in its _rbuf buffer.
+        if wait is None or self.rfile._rbuf.tell() > 0:
+            return True
+        return wait(self.connection, self.timeout)
+
+    def handle_one_request(self):
+        """Handle a single request, leaving the connection ready for the next
+        one."""
+        self.command = None
+        self.body_consumed = False
+        self.requests_served += 1
+        self.status_code = None
+        self.phase_times = {}
+        self.route = 'other'
+        counted = self.metrics is not None or self.access_log is not None
+        if counted:
+            received, sent = self.rfile.count, self.wfile.count
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+            if self.command is not None and not self.close_connection:
+                self.discard_request_body()
+        finally:
+            if counted and self.command is not None:
+                duration = time.time() - self.request_start
+                received, sent = self.rfile.count - received, self.wfile.count - sent
+                status = self.status_code or 0
+                if self.metrics is not None:
+                    method = self.command if hasattr(self, 'do_' + self.command) else 'other'
+                    self.metrics.record(self.route, method, status, duration, self.phase_times,
+                                        received, sent)
+                if self.access_log is not None:
+                    self.access_log.log([('client', self.client_address[0]), ('method', self.command),
+                                         ('path', self.path), ('status', status),
+                                         ('duration_ms', round(duration * 1000, 3)),
+                                         ('bytes_in', received), ('bytes_out', sent)],
+                                        failed=not 0 < status < 400)
+
+    def log_request(self, code='-', size='-'):
+        # The requests are logged once answered, see handle_one_request.
+        pass
+
+    def log_message(self, format, *args):
+        """Log the errors reported by BaseHTTPServer, such as the timeouts."""
+        if self.access_log is not None:
+            self.access_log.log([('client', self.client_address[0]), ('message', format % args)],
+                                failed=True)
+
+    def send_response(self, code, message=None):
+        """Start a response, announcing the closing of the connection if
+        close_connection is set."""
+        self.status_code = code
+        self.connection_announced = False
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+        if (not getattr(self.server, 'allow_keepalive', False) or
+                self.requests_served >= setting('max_keepalive_requests')):
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+
+    def send_header(self, keyword, value):
+        # The Connection header is sent once, by send_response, even if
+        # BaseHTTPServer's send_error sends it again.
+        if keyword.lower() == 'connection':
+            if self.connection_announced:
+                return
+            self.connection_announced = True
+        BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword, value)
 
     # ----------
     # Routes:
@@ -114,7 +579,16 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         commands['get_commands'] = base_url
         commands['get_files_list'] = base_url + '/files'
         commands['get_file_content'] = base_url + '/files/:filename'
+        commands['get_raw_file_content'] = base_url + '/raw/:filename'
+        commands['get_files_tree'] = base_url + '/tree/:dirname'
+        commands['get_events'] = base_url + '/events'
+        commands['search_files'] = base_url + '/search'
+        commands['find_files'] = base_url + '/find'
+        commands['get_metrics'] = base_url + '/metrics'
         commands['get_server_version'] = base_url + '/version'
+        commands['batch_read_files'] = base_url + '/batch/read'
+        commands['batch_write_files'] = base_url + '/batch/write'
+        commands['open_session'] = base_url + '/session'
 
         self.send_jsend(commands)
 
@@ -136,81 +610,752 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             else:
                 self.send_listdir(requested_path)
 
+    def route_get_tree(self, requested_dir):
+        """Send the tree of the files under requested_dir, down to the depth
+        given in the query (1 by default, the direct children only).
+
+        The tree is cut after 'limit' entries, and next_cursor is then the
+        cursor to pass to get the next page. The directories already sent in
+        a previous page come back with a 'continued' flag, holding the
+        following entries."""
+        if not self.is_authorized_path(requested_dir):
+            self.route_403()
+            return
+        elif not os.path.isdir(requested_dir):
+            self.route_400(requested_dir + ' is not a directory')
+            return
+
+        try:
+            depth = int(self.query.get('depth', ['1'])[-1])
+            limit = int(self.query.get('limit', [setting('tree_max_entries')])[-1])
+            limit = min(limit, setting('tree_max_entries'))
+            cursor = self.query.get('cursor', [None])[-1]
+            after = None if cursor is None else tuple(base64.urlsafe_b64decode(cursor).split(os.sep))
+            if depth < 1 or limit < 1:
+                raise ValueError
+        except (ValueError, TypeError):
+            self.route_400("invalid depth, limit or cursor")
+            return
+
+        relative_dir = os.path.normpath(os.path.relpath(requested_dir, os.getcwd()))
+        if relative_dir == os.curdir:
+            relative_dir = ''
+
+        realdir = resolve_path(requested_dir)
+        try:
+            list_directory(realdir)
+        except os.error:
+            self.route_404()
+            return
+
+        # The tree is walked while it is encoded: the cursor is only known
+        # once all the entries are.
+        authorizer = PATH_AUTHORIZER.get()
+        tree_walk = TreeWalk(authorizer.root, authorizer.is_blacklisted, limit, after)
+
+        def next_cursor():
+            if tree_walk.truncated:
+                return base64.urlsafe_b64encode(os.sep.join(tree_walk.last))
+            return None
+
+        self.send_jsend_stream(collections.OrderedDict([
+            ('path', relative_dir),
+            ('entries', tree_walk.walk(realdir, relative_dir, depth, frozenset([realdir]))),
+            ('next_cursor', LateValue(next_cursor))]))
+
+    def route_get_events(self):
+        """Send the changes of the files of the served tree.
+
+        The changes come as server-sent events if the client accepts them.
+        Otherwise this is a long poll: the events following the 'since' id
+        given in the query are sent back as soon as there are some, or after
+        'timeout' seconds. Without 'since', the current id is sent back right
+        away. A 'reset' event means that some changes were lost."""
+        if isinstance(self.server, PreforkHTTPServer):
+            # Each worker process would send its own events, with its own
+            # ids: the clients would get a reset from every other worker.
+            self.send_jsend("The events are not available in prefork mode", False, 501)
+            return
+        try:
+            timeout = min(float(self.query.get('timeout', ['25'])[-1]), MAX_EVENTS_TIMEOUT)
+        except ValueError:
+            self.route_400("invalid timeout")
+            return
+        since = self.headers.getheader('last-event-id') or self.query.get('since', [None])[-1]
+        streaming = 'text/event-stream' in (self.headers.getheader('accept') or '')
+        hub = EVENT_HUB.get()
+        hub.start()
+        if since is None:
+            if not streaming:
+                self.send_jsend({'events': [], 'last_id': hub.last_id()})
+                return
+            since = hub.last_id()
+
+        # The workers waiting for events cannot serve other requests: only
+        # some of them may wait.
+        slots = getattr(self.server, 'event_stream_slots', None)
+        waiting = slots is not None and slots.acquire(False)
+        if not waiting:
+            if streaming:
+                self.send_jsend("Too many event streams, poll instead", False, 503,
+                                headers=[("Retry-After", "10")])
+                return
+            timeout = 0
+
+        try:
+            if streaming:
+                self.send_event_stream(hub, since)
+            else:
+                events, last_id = hub.wait(since, timeout)
+                self.send_jsend({'events': [dict(event, id=event_id) for event_id, event in events],
+                                 'last_id': last_id})
+        finally:
+            if waiting:
+                slots.release()
+
+    def send_event_stream(self, hub, since):
+        """Send the events following the since id as server-sent events,
+        until the client goes away."""
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        try:
+            self.wfile.flush()
+            while True:
+                events, _ = hub.wait(since, setting('events_heartbeat'))
+                if not events:
+                    self.wfile.write(': keep-alive\n\n')
+                for event_id, event in events:
+                    self.wfile.write('id: %s\ndata: %s\n\n' % (event_id, json.dumps(event)))
+                    since = event_id
+                self.wfile.flush()
+        except socket.error:
+            pass
+
+    def route_get_search(self):
+        """Send the lines of the files matching the query 'q', a literal string
+        or, with the 'regex' flag, a regular expression. The 'ignore_case'
+        flag makes the search case insensitive, and the 'path' directory
+        restricts it to the files under it.
+
+        The files are searched in parallel by the search processes, and sent
+        as they are found, in no particular order. The search stops after
+        'limit' matching lines, and 'truncated' is then true. The binary
+        files, the files bigger than search_max_file_size and the symlinks
+        are skipped."""
+        requested_dir = self.query.get('path', [os.curdir])[-1]
+        try:
+            query = self.query.get('q', [''])[-1].decode('utf-8')
+            limit = int(self.query.get('limit', [setting('search_max_results')])[-1])
+            limit = min(limit, setting('search_max_results'))
+            if not query or limit < 1:
+                raise ValueError
+        except ValueError:
+            self.route_400("invalid query or limit")
+            return
+        if not self.is_authorized_path(requested_dir):
+            self.route_403()
+            return
+        elif not os.path.isdir(requested_dir):
+            self.route_400(requested_dir + ' is not a directory')
+            return
+
+        is_regex = self.query_flag('regex')
+        try:
+            pattern = make_search_pattern(query, is_regex, self.query_flag('ignore_case'))
+        except re.error as e:
+            self.route_400("invalid regular expression: %s" % e)
+            return
+        # Only the files holding the literal as is can match.
+        literal = None
+        if not is_regex and not pattern.flags & re.IGNORECASE:
+            literal = query.encode('utf-8')
+
+        authorizer = PATH_AUTHORIZER.get()
+        root = authorizer.root.rstrip(os.sep) + os.sep
+        realdir = resolve_path(requested_dir)
+        relative_dir = realdir[len(root):]
+        pool = SEARCH_POOL.get()
+        index = SEARCH_INDEX.get()
+        candidates = None
+        if index is not None:
+            candidates = index.find(search_literals(query, pattern, is_regex), pool)
+        if candidates is None:
+            files = ((path, path[len(root):])
+                     for path, _, file_stat in walk_tree(realdir, authorizer, IGNORE_MATCHER.get())
+                     if is_searchable_file(path, file_stat, authorizer))
+        else:
+            files = ((root + relative_path, relative_path) for relative_path in candidates
+                     if not relative_dir or is_subpath(relative_path, relative_dir))
+
+        tree_search = TreeSearch(pool, pattern, literal, limit)
+        self.send_jsend_stream(collections.OrderedDict([
+            ('query', query),
+            ('files', tree_search.search(files)),
+            ('truncated', LateValue(lambda: tree_search.truncated))]),
+            block_size=SEARCH_RESULTS_BLOCK_SIZE)
+
+    def route_get_find(self):
+        """Send the paths of the files matching the query 'q' fuzzily, best
+        matches first: the paths holding its characters in order, whatever
+        their case. The whitespace of the query is ignored.
+
+        At most 'limit' paths are sent, each with the positions of the matched
+        characters. 'truncated' is true if there were too many matching paths
+        to rank them all."""
+        query = ''.join(self.query.get('q', [''])[-1].split())
+        try:
+            limit = int(self.query.get('limit', [setting('find_max_results')])[-1])
+            limit = min(limit, setting('find_max_results'))
+            if not query or limit < 1:
+                raise ValueError
+        except ValueError:
+            self.route_400("invalid query or limit")
+            return
+        index = FIND_INDEX.get()
+        if index is None:
+            self.route_400("the index of the file names is disabled")
+            return
+        if not index.ready.wait(FIND_READY_TIMEOUT):
+            self.send_jsend("The index of the file names is being built", False, 503,
+                            headers=[("Retry-After", "5")])
+            return
+
+        paths, truncated = index.find(query, limit)
+        self.send_jsend(collections.OrderedDict([
+            ('query', query),
+            ('files', [{'path': path, 'positions': positions} for path, positions in paths]),
+            ('truncated', truncated)]))
+
+    def route_get_metrics(self):
+        """Send the metrics of the requests served by this process and the
+        hits of its caches, in the Prometheus text format."""
+        if self.metrics is None:
+            self.route_400("the metrics are disabled")
+            return
+        caches = [('listing', LISTING_CACHE.peek()), ('content', CONTENT_CACHE.peek()),
+                  ('compressed', COMPRESSED_CACHE.peek()), ('authentication', AUTH_CACHE.peek())]
+        find_index = FIND_INDEX.peek()
+        if find_index is not None:
+            caches.append(('find', find_index.matches))
+        self.send_body(self.metrics.render([(name, cache) for name, cache in caches
+                                            if cache is not None]),
+                       200, "text/plain; version=0.0.4")
+
+    def route_get_raw_file(self, requested_file):
+        """Send the bare content of a file, without jsend wrapping."""
+        if not self.is_authorized_path(requested_file):
+            self.route_403()
+            return
+        elif not os.path.isfile(requested_file):
+            self.route_400(requested_file + ' is not a file')
+            return
+
+        try:
+            with self.timing('filesystem'):
+                fp = open(resolve_path(requested_file), 'rb')
+                file_stat = os.fstat(fp.fileno())
+        except IOError:
+            self.route_404()
+            return
+
+        with fp:
+            headers = self.make_validator_headers(file_stat)
+            if self.is_not_modified(file_stat):
+                self.send_not_modified(headers)
+                return
+
+            headers.append(("Accept-Ranges", "bytes"))
+            file_size = file_stat.st_size
+            byte_range = self.get_requested_range(file_stat)
+            if (byte_range is None and
+                    setting('compression_min_size') <= file_size <= MAX_COMPRESSED_FILE_SIZE):
+                encoding = self.negotiate_encoding()
+                if encoding is not None:
+                    cache_key = make_cache_key(('raw', fp.name), file_stat)
+                    if self.send_cached(cache_key, "application/octet-stream", headers):
+                        return
+                    with self.timing('filesystem'):
+                        data = fp.read()
+                    with self.timing('serialization'):
+                        body = compress(data, encoding)
+                    if cache_key is not None:
+                        COMPRESSED_CACHE.get().put(cache_key + (encoding,), body)
+                    self.send_body(body, 200, "application/octet-stream", headers, encoding)
+                    return
+
+            if byte_range is None:
+                start, end = 0, file_size
+                self.send_response(200)
+            elif byte_range == 'unsatisfiable':
+                headers.append(("Content-Range", "bytes */%d" % file_size))
+                self.send_jsend("Requested range not satisfiable", False, 416, headers)
+                return
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                headers.append(("Content-Range", "bytes %d-%d/%d" % (start, end - 1, file_size)))
+
+            self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start))
+            for keyword, value in headers:
+                self.send_header(keyword, value)
+            self.end_headers()
+            self.send_file_body(fp, start, end - start)
+
+    def route_head_path(self, requested_path, raw=False):
+        """Send the metadata of a file or a directory in the headers, without
+        reading it."""
+        if not self.is_authorized_path(requested_path):
+            self.route_403()
+            return
+
+        try:
+            file_stat = os.stat(resolve_path(requested_path))
+        except OSError:
+            self.route_404()
+            return
+
+        is_file = stat.S_ISREG(file_stat.st_mode)
+        if raw and not is_file:
+            self.route_400(requested_path + ' is not a file')
+            return
+
+        headers = self.make_validator_headers(file_stat)
+        if self.is_not_modified(file_stat):
+            self.send_not_modified(headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+        if raw:
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(file_stat.st_size))
+            self.send_header("Accept-Ranges", "bytes")
+        else:
+            encoding = sys.getfilesystemencoding()
+            self.send_header("Content-type", "text/json; charset=%s" % encoding)
+        self.send_header("X-Type", 'file' if is_file else 'dir')
+        self.send_header("X-Size", str(file_stat.st_size))
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        self.end_headers()
+
     def route_put_file(self, requested_file):
         if not self.is_authorized_path(requested_file):
             self.route_403()
             return
         else:
-            if not os.path.isfile(os.path.realpath(requested_file)):
+            if not os.path.isfile(resolve_path(requested_file)):
                 self.route_400("The requested file is a directory")
                 return
 
             try:
-                with open(os.path.realpath(requested_file), 'w') as fp:
-                    # Read request body.
-                    content_len = int(self.headers.getheader('content-length'))
-                    body = self.rfile.read(content_len)
-                    # print('PUT request body:\n' + body)
+                body = self.read_request_body()
+                # print('PUT request body:\n' + body)
 
-                    body = json.loads(body)
+                body = json.loads(body)
 
-                    # Check body consistency.
-                    if not 'content' in body:
-                        self.route_400("body must contain a 'content' field")
+                # Check body consistency.
+                if not 'content' in body:
+                    self.route_400("body must contain a 'content' field")
+                    return
 
-                    fp.write(str(body['content']))
+                # The file is only replaced once its new content is complete.
+                with self.timing('filesystem'):
+                    write_file_atomically(resolve_path(requested_file),
+                                          [encode_content(body['content'])],
+                                          fsync=self.query_flag('fsync', setting('fsync_uploads')))
 
                 # If everything was fine, send back the new content of the file.
-                self.send_file_content(os.path.realpath(requested_file))
+                self.send_file_content(resolve_path(requested_file))
 
-            except IOError:
+            except (IOError, OSError):
                 self.route_404()
                 return
-            except KeyError:
+            except (KeyError, ValueError, TypeError):
                 self.route_400()
                 return
 
+    def route_patch_file(self, requested_file):
+        """Modify a file without sending all of its content.
+
+        The body is a json object with the 'base_etag' or the 'base_mtime' of
+        the version of the file that the modifications apply to, and either
+        'edits', a list of objects replacing the characters from 'start' to
+        'end' of that version by 'text', or 'diff', a unified diff. If the
+        file changed since that version, nothing is written and the current
+        etag and mtime are sent back with a 409. Otherwise the description of
+        the new version is sent back, without its content."""
+        if not self.is_authorized_path(requested_file):
+            self.route_403()
+            return
+        elif not os.path.isfile(resolve_path(requested_file)):
+            self.route_400(requested_file + ' is not a file')
+            return
+
+        try:
+            body = json.loads(self.read_request_body())
+            if not isinstance(body, dict) or ('edits' in body) == ('diff' in body):
+                raise ValueError
+            if 'base_etag' not in body and 'base_mtime' not in body:
+                raise ValueError
+            # The wildcard etag would match any version of the file.
+            if 'base_etag' in body and (not isinstance(body['base_etag'], basestring) or
+                                        body['base_etag'].strip() == '*'):
+                raise ValueError
+        except ValueError:
+            self.route_400("body must contain a 'base_etag' other than '*' or a 'base_mtime', "
+                           "and either 'edits' or a 'diff'")
+            return
+
+        real_path = resolve_path(requested_file)
+        try:
+            # No other write must happen between the check of the base and
+            # the replacement of the file.
+            with DirectoryLock(PATH_AUTHORIZER.get().root):
+                with self.timing('filesystem'):
+                    fp = open(real_path, 'rb')
+                    file_stat = os.fstat(fp.fileno())
+                with fp:
+                    etag, mtime = make_etag(file_stat), format_mtime(file_stat)
+                    if (('base_etag' in body and not etag_matches(body['base_etag'], etag)) or
+                            ('base_mtime' in body and not mtime_matches(body['base_mtime'], file_stat))):
+                        self.send_jsend({'path': requested_file, 'etag': etag, 'mtime': mtime},
+                                        False, 409)
+                        return
+                    with self.timing('filesystem'):
+                        content = fp.read()
+
+                try:
+                    content = content.decode('utf-8')
+                except UnicodeDecodeError:
+                    self.send_jsend("Not a UTF-8 text file", False, 415)
+                    return
+
+                try:
+                    if 'edits' in body:
+                        content = apply_edits(content, body['edits'])
+                    else:
+                        content = apply_unified_diff(content, body['diff'])
+                except (ValueError, TypeError, KeyError) as e:
+                    self.route_400("the patch does not apply: %s" % e)
+                    return
+
+                with self.timing('filesystem'):
+                    write_file_atomically(real_path, [content.encode('utf-8')],
+                                          fsync=self.query_flag('fsync', setting('fsync_uploads')))
+                    file_stat = os.stat(real_path)
+        except (IOError, OSError):
+            self.route_404()
+            return
+
+        self.send_jsend(self.make_file_entry(requested_file, file_stat),
+                        headers=self.make_validator_headers(file_stat))
+
     def route_post_file(self, new_file):
         if not self.is_authorized_new_path(new_file):
             self.route_403()
             return
-        elif os.path.exists(os.path.realpath(new_file)):
+        elif os.path.exists(resolve_path(new_file)):
             self.route_400("File '" + new_file + "' already exists")
             return
         else:
             try:
                 # Make the potentially missing intermediate directories.
-                if not os.path.exists(os.path.dirname(os.path.realpath(new_file))):
-                    os.makedirs(os.path.dirname(os.path.realpath(new_file)))
+                make_parent_directories(resolve_path(new_file))
 
-                with open(os.path.realpath(new_file), 'w+') as fp:
-                    # Read request body.
-                    content_len = int(self.headers.getheader('content-length'))
-                    body = self.rfile.read(content_len)
+                body = self.read_request_body()
 
-                    body = json.loads(body)
+                body = json.loads(body)
 
-                    # Check body consistency.
-                    if not 'content' in body:
-                        self.route_400("body must contain a 'content' field")
+                # Check body consistency.
+                if not 'content' in body:
+                    self.route_400("body must contain a 'content' field")
+                    return
 
-                    fp.write(str(body['content']))
+                with self.timing('filesystem'):
+                    write_file_atomically(resolve_path(new_file), [encode_content(body['content'])],
+                                          fsync=self.query_flag('fsync', setting('fsync_uploads')),
+                                          replace=False)
 
                 # If everything was fine, send back the new content of the file.
-                self.send_file_content(os.path.realpath(new_file))
+                self.send_file_content(resolve_path(new_file))
 
             except IOError:
                 self.route_404()
                 return
-            except KeyError:
+            except (KeyError, ValueError, TypeError):
                 self.route_400()
                 return
-            except os.Error:
-                self.route_400()
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    self.route_400("File '" + new_file + "' already exists")
+                else:
+                    self.route_400()
+                return
+
+    def route_post_batch_read(self):
+        """Send the content of several files at once.
+
+        The body is a json object with a 'paths' list. The files come back in
+        the same order, described as by the files route, or with an 'error'
+        and a 'status' if they cannot be sent. The files are read in
+        parallel."""
+        try:
+            paths = json.loads(self.read_request_body())['paths']
+            if not isinstance(paths, list) or not all(isinstance(path, basestring) for path in paths):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            self.route_400("body must contain a 'paths' list")
+            return
+        if len(paths) > setting('batch_max_files'):
+            self.route_400("a batch can contain at most %d paths" % setting('batch_max_files'))
+            return
+        # Like the paths of the other routes, which come from the url.
+        encoding = sys.getfilesystemencoding()
+        paths = [path.encode(encoding) if isinstance(path, unicode) else path for path in paths]
+
+        pool = BATCH_POOL.get()
+        # The pool threads do not time their own phases.
+        with self.timing('filesystem'):
+            opened = pool.map(self.open_batch_file, paths)
+        try:
+            # The size caps apply in the order of the paths.
+            remaining_size = setting('batch_max_size')
+            readable = []
+            for index, (entry, fp) in enumerate(opened):
+                if fp is None:
+                    continue
+                size = int(entry['size'])
+                if size > setting('batch_max_file_size'):
+                    opened[index] = (self.make_batch_error(entry['path'], 413, 'File too large'), fp)
+                elif size > remaining_size:
+                    opened[index] = (self.make_batch_error(entry['path'], 413, 'Batch too large'), fp)
+                else:
+                    remaining_size -= size
+                    readable.append((entry, fp))
+
+            with self.timing('filesystem'):
+                pool.map(self.read_batch_file, readable)
+        finally:
+            for _, fp in opened:
+                if fp is not None:
+                    fp.close()
+
+        self.send_jsend_stream(iter([entry for entry, _ in opened]))
+
+    def route_post_batch_write(self):
+        """Write several files at once.
+
+        The body is a json object with a 'files' list, of objects holding the
+        'path' and the new 'content' of a file. The 'expected_etag' or the
+        'expected_mtime' of a file make sure that it was not modified since it
+        was read, a null expected_etag that it does not exist yet.
+
+        The new contents are written to temporary files first. Then, if all
+        the files are as expected, they are all replaced. Otherwise none is,
+        and the conflicting files are sent back with a 409."""
+        try:
+            files = json.loads(self.read_request_body())['files']
+            if not isinstance(files, list) or not all(isinstance(item, dict) and 'content' in item and
+                                                      isinstance(item.get('path'), basestring)
+                                                      for item in files):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            self.route_400("body must contain a 'files' list of paths and contents")
+            return
+        if len(files) > setting('batch_max_files'):
+            self.route_400("a batch can contain at most %d files" % setting('batch_max_files'))
+            return
+
+        encoding = sys.getfilesystemencoding()
+        paths = [item['path'].encode(encoding) if isinstance(item['path'], unicode) else item['path']
+                 for item in files]
+        for path in paths:
+            if not self.is_authorized_new_path(path):
+                self.route_403()
+                return
+            elif os.path.isdir(resolve_path(path)):
+                self.route_400(path + ' is a directory')
+                return
+        real_paths = [resolve_path(path) for path in paths]
+        if len(set(real_paths)) != len(real_paths):
+            self.route_400("the same file is written twice")
+            return
+
+        fsync = self.query_flag('fsync', setting('fsync_uploads'))
+        staged = []
+        made_directories = []
+        committed = False
+        try:
+            try:
+                with self.timing('filesystem'):
+                    for real_path, item in zip(real_paths, files):
+                        made_directories.extend(make_parent_directories(real_path))
+                        staged.append(stage_file(real_path, [encode_content(item['content'])]))
+                    if fsync:
+                        for temporary_path in staged:
+                            fsync_file(temporary_path)
+
+                # Lock the root directory so that no other write to the files
+                # happens between the checks and the renamings.
+                with DirectoryLock(PATH_AUTHORIZER.get().root):
+                    conflicts = [conflict for conflict in map(self.check_batch_precondition,
+                                                              paths, real_paths, files)
+                                 if conflict is not None]
+                    if conflicts:
+                        self.send_jsend(conflicts, False, 409)
+                        return
+
+                    committed = True
+                    for index, real_path in enumerate(real_paths):
+                        os.rename(staged[index], real_path)
+                        staged[index] = None
+
+                if fsync:
+                    for directory in set(os.path.dirname(real_path) for real_path in real_paths):
+                        fsync_directory(directory)
+                entries = [self.make_file_entry(path, os.stat(real_path))
+                           for path, real_path in zip(paths, real_paths)]
+            except (IOError, OSError):
+                self.route_404()
+                return
+        finally:
+            for temporary_path in staged:
+                if temporary_path is not None and os.path.exists(temporary_path):
+                    os.unlink(temporary_path)
+            if not committed:
+                # A rejected batch leaves no trace, but for the directories
+                # filled by other requests meanwhile.
+                for directory in reversed(made_directories):
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        pass
+
+        self.send_jsend(entries)
+
+    def check_batch_precondition(self, path, real_path, item):
+        """Return the description of the conflict if the file at real_path
+        is not as expected by item, else None."""
+        try:
+            file_stat = os.stat(real_path)
+        except OSError:
+            file_stat = None
+
+        conflict = {'path': path, 'status': 409, 'error': 'Conflict'}
+        if file_stat is not None:
+            conflict['etag'] = make_etag(file_stat)
+            conflict['mtime'] = format_mtime(file_stat)
+
+        if 'expected_etag' in item:
+            expected_etag = item['expected_etag']
+            if expected_etag is None:
+                if file_stat is not None:
+                    return conflict
+            elif file_stat is None or not etag_matches(expected_etag, conflict['etag']):
+                return conflict
+        if 'expected_mtime' in item:
+            if file_stat is None or not mtime_matches(item['expected_mtime'], file_stat):
+                return conflict
+        return None
+
+    def open_batch_file(self, path):
+        """Return the entry describing the file at path and the file opened,
+        or an error entry and None."""
+        if not self.is_authorized_new_path(path):
+            return self.make_batch_error(path, 403, 'Forbidden'), None
+        try:
+            fp = open(resolve_path(path), 'rb')
+        except IOError as e:
+            if e.errno == errno.EISDIR:
+                return self.make_batch_error(path, 400, path + ' is not a file'), None
+            return self.make_batch_error(path, 404, 'Not found'), None
+
+        file_stat = os.fstat(fp.fileno())
+        if not stat.S_ISREG(file_stat.st_mode):
+            fp.close()
+            return self.make_batch_error(path, 400, path + ' is not a file'), None
+        return self.make_file_entry(path, file_stat), fp
+
+    def read_batch_file(self, opened_file):
+        """Add its content to the entry of an opened file."""
+        entry, fp = opened_file
+        # The size caps were checked against the size of the file when it
+        # was opened: it must not have grown since.
+        size = int(entry['size'])
+        content = fp.read(size + 1)
+        if len(content) > size:
+            error = self.make_batch_error(entry['path'], 413, 'File too large')
+        else:
+            try:
+                content.decode('utf-8')
+            except UnicodeDecodeError:
+                error = self.make_batch_error(entry['path'], 415, 'Not a UTF-8 text file')
+            else:
+                entry['content'] = content
                 return
+        entry.clear()
+        entry.update(error)
+
+    def make_batch_error(self, path, status, message):
+        return {'path': path, 'status': status, 'error': message}
+
+    def route_put_raw_file(self, requested_file):
+        """Replace the content of a file by the raw request body."""
+        if not self.is_authorized_path(requested_file):
+            self.route_403()
+            return
+        elif not os.path.isfile(resolve_path(requested_file)):
+            self.route_400("The requested file is a directory")
+            return
+        else:
+            self.receive_raw_file(requested_file, replace=True)
+
+    def route_post_raw_file(self, new_file):
+        """Create a file with the raw request body as content."""
+        if not self.is_authorized_new_path(new_file):
+            self.route_403()
+            return
+        elif os.path.exists(resolve_path(new_file)):
+            self.route_400("File '" + new_file + "' already exists")
+            return
+        else:
+            try:
+                # Make the potentially missing intermediate directories.
+                make_parent_directories(resolve_path(new_file))
             except OSError:
                 self.route_400()
                 return
+            self.receive_raw_file(new_file, replace=False)
+
+    def route_post_session(self):
+        """Exchange the credentials of the request for a session token, to
+        send as 'Authorization: Bearer <token>' instead of the credentials
+        until it expires or is revoked."""
+        if self.session is not None:
+            self.send_jsend("A session cannot be opened with a session token", False, 403)
+            return
+        expires = int(time.time()) + setting('session_lifetime')
+        self.send_jsend({'token': make_session_token(os.urandom(16).encode('hex'), expires),
+                         'expires': expires})
+
+    def route_delete_session(self):
+        """Revoke the session token the request is authenticated with."""
+        if self.session is None:
+            self.route_400("the request is not authenticated with a session token")
+            return
+        session_id, expires = self.session
+        if not REVOKED_SESSIONS.revoke(session_id, expires):
+            self.send_jsend("Too many sessions revoked", False, 503, headers=[("Retry-After", "60")])
+            return
+        self.send_jsend("Session closed")
 
     def route_400(self, explanation=None):
         message = "Bad request"
@@ -225,15 +1370,128 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def route_404(self):
         self.send_jsend("Not found", False, 404)
 
+    def route_405(self, allowed_methods):
+        self.send_jsend("Method not allowed", False, 405, headers=[("Allow", allowed_methods)])
+
     # ----------
     # Helpers
-    def send_jsend(self, data, success=True, status_code=None):
+    def read_request_body(self):
+        """Read the whole body of the request.
+
+        Raise ValueError if the body is malformed or ends prematurely."""
+        try:
+            return ''.join(self.iter_request_body())
+        except ValueError:
+            # Whatever remains of the body cannot be skipped safely.
+            self.close_connection = 1
+            raise
+
+    def iter_request_body(self):
+        """Generate the body of the request block by block, decoding the
+        chunked transfer encoding.
+
+        Raise ValueError if the body is malformed or ends prematurely."""
+        self.body_consumed = True
+        self.send_continue()
+        if self.headers.getheader('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = self.rfile.readline(1024)
+                chunk_size = int(size_line.split(';')[0].strip(), 16)
+                if chunk_size < 0:
+                    raise ValueError('Negative chunk size')
+                elif chunk_size == 0:
+                    break
+                while chunk_size > 0:
+                    data = self.rfile.read(min(FILE_CHUNK_SIZE, chunk_size))
+                    if not data:
+                        raise ValueError('Truncated body')
+                    chunk_size -= len(data)
+                    yield data
+                if self.rfile.readline(1024) not in ('\r\n', '\n'):
+                    raise ValueError('Malformed chunk')
+            # Skip the trailers.
+            while self.rfile.readline(1024) not in ('\r\n', '\n', ''):
+                pass
+        else:
+            remaining = int(self.headers.getheader('content-length') or 0)
+            while remaining > 0:
+                data = self.rfile.read(min(FILE_CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError('Truncated body')
+                remaining -= len(data)
+                yield data
+
+    def send_continue(self):
+        """Let the client send the body it is holding back until the headers
+        are accepted."""
+        if (self.request_version >= 'HTTP/1.1' and
+                self.headers.getheader('expect', '').lower() == '100-continue'):
+            self.wfile.write('%s 100 Continue\r\n\r\n' % self.protocol_version)
+            self.wfile.flush()
+
+    def is_raw_upload(self):
+        """Is the request body the bare file content, rather than jsend?"""
+        return self.headers.gettype() == 'application/octet-stream'
+
+    def query_flag(self, name, default=False):
+        """Return the boolean value of a query parameter."""
+        if name not in self.query:
+            return default
+        return self.query[name][-1].lower() in ('1', 'true', 'yes', 'on', '')
+
+    def receive_raw_file(self, filepath, replace):
+        """Stream the request body to a temporary file, then move it to
+        filepath and send back the description of the new file."""
+        realpath = resolve_path(filepath)
+        try:
+            # The body is read from the network while it is written.
+            with self.timing('filesystem'):
+                write_file_atomically(realpath, self.iter_request_body(),
+                                      fsync=self.query_flag('fsync', setting('fsync_uploads')),
+                                      replace=replace)
+                file_stat = os.stat(realpath)
+        except ValueError:
+            self.close_connection = 1
+            self.route_400("malformed request body")
+            return
+        except (IOError, OSError) as e:
+            # Whatever remains of the body cannot be skipped safely.
+            self.close_connection = 1
+            if e.errno == errno.EEXIST:
+                self.route_400("File '" + filepath + "' already exists")
+            else:
+                self.route_404()
+            return
+
+        self.send_jsend(self.make_file_entry(filepath, file_stat),
+                        headers=self.make_validator_headers(file_stat))
+
+    def discard_request_body(self):
+        """Skip the body of the request if the route did not read it, so that
+        the next request of the connection can be read.
+
+        Bodies of unknown or big size are not worth reading: the connection is
+        closed instead."""
+        if self.body_consumed:
+            return
+        try:
+            if self.headers.getheader('transfer-encoding') is not None:
+                raise ValueError
+            content_len = int(self.headers.getheader('content-length') or 0)
+            if content_len > MAX_DISCARDED_BODY_SIZE:
+                raise ValueError
+        except ValueError:
+            self.close_connection = 1
+            return
+        self.rfile.read(content_len)
+
+    def send_jsend(self, data, success=True, status_code=None, headers=None):
         """Send data in jsend format.
 
         The data parameter is any json dumpable Python object. Defaults status is
         success and default status_code is 200."""
         jsend = self.make_jsend(data, success)
-        self.send_json(jsend, status_code)
+        self.send_json(jsend, status_code, headers)
 
     def make_jsend(self, data, success=True):
         """Transform any json dumpable Python object in a jsend string.
@@ -245,24 +1503,261 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             status = 'failure'
 
         formatted = {'status': status, 'data': data}
-        return json.dumps(formatted)
+        with self.timing('serialization'):
+            return json.dumps(formatted)
 
-    def send_json(self, json_string, status_code=None):
+    def send_json(self, json_string, status_code=None, headers=None, cache_key=None):
         """Send some json with the correct headers and the given status code.
 
         Default status code is 200. The given json_string must be a valid json
-        string."""
+        string. The optional headers are a list of (keyword, value) pairs.
+        If the json gets compressed and a cache_key is given, the compressed
+        json is cached for send_cached."""
         if status_code is None:
             status_code = 200
 
-        self.send_response(status_code)
-        self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+        content_encoding = None
+        if len(json_string) >= setting('compression_min_size'):
+            content_encoding = self.negotiate_encoding()
+        if content_encoding is not None:
+            with self.timing('serialization'):
+                json_string = compress(json_string, content_encoding)
+            if cache_key is not None:
+                COMPRESSED_CACHE.get().put(cache_key + (content_encoding,), json_string)
+
+        encoding = sys.getfilesystemencoding()
+        self.send_body(json_string, status_code, "text/json; charset=%s" % encoding, headers,
+                       content_encoding)
+
+    def send_cached(self, cache_key, content_type, headers=None):
+        """Send the compressed body cached under cache_key, if the client
+        accepts it. Return whether it was sent."""
+        content_encoding = self.negotiate_encoding()
+        if content_encoding is None or cache_key is None:
+            return False
+        body = COMPRESSED_CACHE.get().get(cache_key + (content_encoding,))
+        if body is None:
+            return False
+        self.send_body(body, 200, content_type, headers, content_encoding)
+        return True
+
+    def send_body(self, body, status_code, content_type, headers=None, content_encoding=None):
+        """Send a complete response."""
+        self.send_response(status_code)
+        self.send_content_headers(content_type, headers, content_encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_content_headers(self, content_type, headers=None, content_encoding=None):
+        """Send the headers describing the body of the response. The optional
+        headers are a list of (keyword, value) pairs."""
+        self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+        self.send_header("Content-type", content_type)
+        if setting('compression'):
+            self.send_header("Vary", "Accept-Encoding")
+        if content_encoding is not None:
+            self.send_header("Content-Encoding", content_encoding)
+        for keyword, value in headers or []:
+            if keyword == "ETag" and content_encoding is not None:
+                # Each encoding of the content is a distinct representation.
+                value = value[:-1] + '-' + content_encoding + '"'
+            self.send_header(keyword, value)
+
+    def negotiate_encoding(self):
+        """Return the content encoding to compress the response with, or None
+        if the client does not accept any."""
+        if not setting('compression'):
+            return None
+        accept_encoding = self.headers.getheader('accept-encoding')
+        if not accept_encoding:
+            return None
+
+        qualities = {}
+        for item in accept_encoding.split(','):
+            parameters = item.split(';')
+            quality = 1.0
+            for parameter in parameters[1:]:
+                name, _, value = parameter.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[parameters[0].strip().lower()] = quality
+
+        for content_encoding in CONTENT_ENCODINGS:
+            if qualities.get(content_encoding, qualities.get('*', 0.0)) > 0:
+                return content_encoding
+        return None
+
+    def send_jsend_stream(self, data, success=True, status_code=None, headers=None,
+                          block_size=FILE_CHUNK_SIZE):
+        """Send data in jsend format, encoding it while it is sent.
+
+        Besides json dumpable objects, data may contain iterators, StreamedText
+        and LateValue objects, see iter_json."""
+        if success:
+            status = 'success'
+        else:
+            status = 'failure'
+
+        formatted = collections.OrderedDict([('status', status), ('data', data)])
+        self.send_json_stream(iter_json(formatted), status_code, headers, block_size)
+
+    def send_json_stream(self, json_chunks, status_code=None, headers=None, block_size=FILE_CHUNK_SIZE):
+        """Send json produced piece by piece, with the correct headers and the
+        given status code.
+
+        The pieces are written as they come, grouped in blocks of about
+        block_size bytes. The json fitting in a single block is sent as usual,
+        bigger one are sent with chunked transfer encoding to HTTP/1.1 clients,
+        and ended by the closing of the connection for older ones."""
+        if status_code is None:
+            status_code = 200
+
+        json_chunks = iter(json_chunks)
+        pending = []
+        pending_size = 0
+        for piece in json_chunks:
+            pending.append(piece)
+            pending_size += len(piece)
+            if pending_size >= block_size:
+                break
+        else:
+            self.send_json(''.join(pending), status_code, headers)
+            return
+
+        chunked = self.request_version >= 'HTTP/1.1'
+        if not chunked:
+            # The end of the body is told by the closing of the connection.
+            self.close_connection = 1
+        content_encoding = self.negotiate_encoding()
+        self.send_response(status_code)
         encoding = sys.getfilesystemencoding()
-        self.send_header("Content-type", "text/json; charset=%s" % encoding)
-        self.send_header("Content-Length", str(len(json_string)))
+        self.send_content_headers("text/json; charset=%s" % encoding, headers, content_encoding)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        compressor = None
+        if content_encoding is not None:
+            compressor = make_compressor(content_encoding)
+
+        def write(data, last=False):
+            if compressor is not None:
+                # Flush the compressor so that each block can be decoded as
+                # soon as it is received.
+                data = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else
+                                                                    zlib.Z_SYNC_FLUSH)
+            if not chunked:
+                self.wfile.write(data)
+            elif data:
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+        write(''.join(pending))
+        pending = []
+        pending_size = 0
+        for piece in json_chunks:
+            pending.append(piece)
+            pending_size += len(piece)
+            if pending_size >= block_size:
+                write(''.join(pending))
+                pending = []
+                pending_size = 0
+        write(''.join(pending), last=True)
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+
+    def send_file_body(self, fp, offset, length):
+        """Send length bytes of the opened file fp, from offset, as the body
+        of the response, block by block."""
+        sent = 0
+        fp.seek(offset)
+        while sent < length:
+            data = fp.read(min(FILE_CHUNK_SIZE, length - sent))
+            if not data:
+                break
+            self.wfile.write(data)
+            sent += len(data)
+
+        if sent < length:
+            # The file has been truncated in the meantime, the announced
+            # Content-Length cannot be honoured anymore.
+            self.close_connection = 1
+
+    def send_not_modified(self, headers):
+        """Tell the client that its cached copy is still valid."""
+        self.send_response(304)
+        self.send_header("Access-Control-Allow-Origin", self.allow_origin)
+        for keyword, value in headers:
+            self.send_header(keyword, value)
         self.end_headers()
 
-        self.wfile.write(json_string)
+    def make_validator_headers(self, file_stat):
+        """Return the headers letting the client revalidate its copy of the
+        file described by file_stat."""
+        return [("ETag", make_etag(file_stat)),
+                ("Last-Modified", self.date_time_string(int(file_stat.st_mtime))),
+                ("X-Mtime", format_mtime(file_stat)),
+                ("Access-Control-Expose-Headers",
+                 "ETag, Last-Modified, X-Mtime, X-Type, X-Size, Content-Range")]
+
+    def is_not_modified(self, file_stat):
+        """Does the conditional request match the file described by
+        file_stat?"""
+        if_none_match = self.headers.getheader('if-none-match')
+        if if_none_match is not None:
+            return etag_matches(if_none_match, make_etag(file_stat))
+
+        if_modified_since = parse_http_date(self.headers.getheader('if-modified-since'))
+        if if_modified_since is not None:
+            return int(file_stat.st_mtime) <= if_modified_since
+
+        return False
+
+    def get_requested_range(self, file_stat):
+        """Return the (start, end) byte range requested by the client, end
+        excluded, or None to send the whole file, or 'unsatisfiable'.
+
+        Only single ranges are honoured, requests of several ranges get the
+        whole file."""
+        range_header = self.headers.getheader('range')
+        if range_header is None:
+            return None
+
+        # The range only applies if the client has the current version.
+        if_range = self.headers.getheader('if-range')
+        if if_range is not None:
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                if if_range != make_etag(file_stat):
+                    return None
+            elif parse_http_date(if_range) != int(file_stat.st_mtime):
+                return None
+
+        match = re.match(r'bytes=(\d*)-(\d*)$', range_header.replace(' ', ''))
+        if match is None or match.groups() == ('', ''):
+            return None
+
+        file_size = file_stat.st_size
+        first, last = match.groups()
+        if first == '':
+            # Suffix range: the last bytes of the file.
+            start = max(0, file_size - int(last))
+            end = file_size
+        else:
+            start = int(first)
+            end = file_size if last == '' else min(int(last) + 1, file_size)
+            if int(first) > int(last or first):
+                return None
+
+        if start >= end:
+            return 'unsatisfiable'
+        return start, end
 
     def send_listdir(self, dirname):
         """Send the listdir result of the given dirname if it is in an
@@ -274,23 +1769,30 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.route_400(dirname + ' is not a directory')
             return
         else:
+            realdir = resolve_path(dirname)
             try:
-                paths = []
-                for item in os.listdir(dirname):
-                    if not self.is_blacklisted_path(item):
-                        entry = {}
-                        entry['name'] = item
-                        if os.path.normpath(os.path.relpath(dirname, os.getcwd())) == os.curdir:
-                            entry['path'] = item
-                        else:
-                            entry['path'] = os.path.join(os.path.relpath(dirname, os.getcwd()), item)
-                        entry['type'] = 'file' if os.path.isfile(os.path.join(dirname, item)) else 'dir'
-                        paths.append(entry)
+                with self.timing('filesystem'):
+                    listing = list_directory(realdir)
             except os.error:
                 self.route_404()
                 return
 
-        self.send_jsend(paths)
+        is_blacklisted = PATH_AUTHORIZER.get().is_blacklisted
+
+        def iter_entries():
+            """Build the entries while they are encoded."""
+            for item, is_file in listing:
+                if not is_blacklisted(os.path.join(realdir, item)):
+                    entry = {}
+                    entry['name'] = item
+                    if os.path.normpath(os.path.relpath(dirname, os.getcwd())) == os.curdir:
+                        entry['path'] = item
+                    else:
+                        entry['path'] = os.path.join(os.path.relpath(dirname, os.getcwd()), item)
+                    entry['type'] = 'file' if is_file else 'dir'
+                    yield entry
+
+        self.send_jsend_stream(iter_entries())
 
     def send_file_content(self, filepath):
         """Send the content of filepath if it is in an authorized dir."""
@@ -304,50 +1806,136 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 # Always read in binary mode. Opening files in text mode may cause
                 # newline translations, making the actual size of the content
                 # transmitted *less* than the content-length!
-                with open(os.path.realpath(filepath), 'rb') as fp:
-                    file_content = fp.read()
+                with self.timing('filesystem'):
+                    fp = open(resolve_path(filepath), 'rb')
                     file_stat = os.fstat(fp.fileno())
-                    file_size = str(file_stat[6])
-                    file_mtime = str(file_stat.st_mtime)
+                with fp:
+                    headers = self.make_validator_headers(file_stat)
+                    if self.is_not_modified(file_stat):
+                        self.send_not_modified(headers)
+                        return
+
+                    entry = self.make_file_entry(filepath, file_stat)
+                    if file_stat.st_size >= STREAMED_CONTENT_THRESHOLD:
+                        # Once the response is started, a decoding error can
+                        # only cut it short: the file is checked first.
+                        with self.timing('filesystem'):
+                            is_text = is_utf8_file(fp)
+                        if not is_text:
+                            self.send_jsend("Not a UTF-8 text file", False, 415)
+                            return
+                        entry['content'] = StreamedText(open_file_mapping(fp, file_stat))
+                        try:
+                            self.send_jsend_stream(entry, headers=headers)
+                        except UnicodeDecodeError:
+                            # The file was modified meanwhile. Closing the
+                            # connection tells the client that the response
+                            # is incomplete.
+                            self.close_connection = 1
+                        return
+
+                    # The jsend depends on the requested path as well.
+                    cache_key = make_cache_key(('jsend', fp.name, entry['path']), file_stat)
+                    encoding = sys.getfilesystemencoding()
+                    if self.send_cached(cache_key, "text/json; charset=%s" % encoding, headers):
+                        return
+
+                    content_cache = CONTENT_CACHE.get()
+                    json_string = content_cache.get(cache_key)
+                    if json_string is None:
+                        with self.timing('filesystem'):
+                            entry['content'] = fp.read()
+                        try:
+                            json_string = self.make_jsend(entry)
+                        except UnicodeDecodeError:
+                            self.send_jsend("Not a UTF-8 text file", False, 415)
+                            return
+                        if cache_key is not None:
+                            content_cache.put(cache_key, json_string)
             except IOError:
                 self.route_404()
                 return
 
-            entry = {'name': os.path.basename(filepath), 'content': file_content,
-                    'size': file_size, 'mtime': file_mtime, 'type': 'file'}
-            if os.path.normpath(os.path.relpath(filepath, os.getcwd())) == os.curdir:
-                entry['path'] = filepath
-            else:
-                entry['path'] = os.path.relpath(filepath, os.getcwd())
-            self.send_jsend(entry)
+            self.send_json(json_string, headers=headers, cache_key=cache_key)
+
+    def make_file_entry(self, filepath, file_stat):
+        """Describe the file at filepath, without its content."""
+        entry = {'name': os.path.basename(filepath), 'size': str(file_stat.st_size),
+                'mtime': format_mtime(file_stat), 'etag': make_etag(file_stat), 'type': 'file'}
+        if os.path.normpath(os.path.relpath(filepath, os.getcwd())) == os.curdir:
+            entry['path'] = filepath
+        else:
+            entry['path'] = os.path.relpath(filepath, os.getcwd())
+        return entry
 
     def is_authorized_path(self, path):
         """Check that the given path exists and is inside or under os.getcwd()."""
-        if not os.path.exists(os.path.realpath(path)):
-            return False
-        else:
-            return self.is_authorized_new_path(path)
+        with self.timing('authorization'):
+            if not os.path.exists(resolve_path(path)):
+                return False
+            else:
+                return self.is_authorized_new_path(path)
 
     def is_authorized_new_path(self, path):
         """Check that the given path is inside or under os.getcwd()."""
-        if self.is_blacklisted_path(path):
-            return False
-        else:
-            return self.is_in_directory(path, os.getcwd())
+        with self.timing('authorization'):
+            authorizer = PATH_AUTHORIZER.get()
+            real_path = authorizer.resolve(path)
+            if authorizer.is_blacklisted(real_path):
+                return False
+            else:
+                return is_subpath(real_path, authorizer.root)
 
     def is_in_directory(self, path, directory_path):
         """Check that path is inside directory_path or any of its
         subdirectories, following symlinks."""
-        real_dir = os.path.realpath(directory_path)
-        real_path = os.path.realpath(path)
-        return os.path.commonprefix([real_path, real_dir]) == real_dir
+        return is_subpath(resolve_path(path), resolve_path(directory_path))
+
+    def timing(self, phase):
+        """Return a context manager timing its block as the given phase of the
+        request, for the metrics."""
+        return PhaseTimer(self, phase)
 
     def is_authenticated(self):
-        if (self.headers.getheader('Authorization') is None or
-            self.headers.getheader('Authorization') != CONFIG['authentication_string']):
-            print('Unauthorized request from ' + str(self.client_address))
-            print('Request headers:\n' + str(self.headers))
-            jsend = self.make_jsend('Unauthorized', False)
+        """Check the credentials of the request, or answer a 401.
+
+        The clients failing too often get a 429 instead, without their
+        credentials or session token being checked, unless they were found
+        valid already: the valid clients sharing their address are not locked
+        out."""
+        throttle = AUTH_THROTTLE.get()
+        retry_after = 0
+        with self.timing('authentication'):
+            self.session = None
+            authorization = self.headers.getheader('Authorization')
+            if authorization is None:
+                authenticated = False
+            elif authorization[:7].lower() == 'bearer ':
+                if not is_known_authorization(authorization):
+                    retry_after = throttle.retry_after(self.client_address[0])
+                if not retry_after:
+                    # The known tokens are checked too: they may have expired
+                    # or been revoked since.
+                    self.session = check_session_token(authorization[7:].strip())
+                    if self.session is not None:
+                        remember_authorization(authorization)
+                authenticated = self.session is not None
+            elif is_known_authorization(authorization):
+                authenticated = True
+            else:
+                retry_after = throttle.retry_after(self.client_address[0])
+                authenticated = not retry_after and is_valid_authorization(authorization)
+        if retry_after:
+            # The client might not wait for the answer to send its next try.
+            self.close_connection = 1
+            self.send_jsend("Too many failed authentications", False, 429,
+                            headers=[("Retry-After", str(int(retry_after) + 1))])
+            return False
+        elif not authenticated:
+            # The clients first trying without credentials are not failing.
+            if authorization is not None:
+                throttle.fail(self.client_address[0])
+            jsend = UNAUTHORIZED_JSEND
 
             self.send_response(401)
             self.send_header('WWW-Authenticate', 'Basic realm=\"insert realm\"')
@@ -357,77 +1945,3005 @@ class ConnectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_header("Content-Length", str(len(jsend)))
             self.end_headers()
 
-            self.wfile.write(jsend)
+            if self.command != 'HEAD':
+                self.wfile.write(jsend)
             return False
         else:
             return True
 
     def is_blacklisted_path(self, path):
         """Is the given path in the BLACKLISTED_FILES collection?"""
-        # return (path in BLACKLISTED_FILES)
-        return (os.path.realpath(path) in [os.path.realpath(item) for item in BLACKLISTED_FILES])
+        return PATH_AUTHORIZER.get().is_blacklisted(resolve_path(path))
 
 
-def exist_conf_file():
-    return os.path.exists(CONFIGURATION_FILENAME)
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTP server handing the accepted connections to a fixed pool of worker
+    threads.
 
+    At most max_in_flight connections are queued or being served at any time,
+    the others are immediately answered with a 503. A worker waiting for the
+    next request of a kept-alive connection gives the connection up as soon as
+    another connection waits for a worker."""
 
-def startConnector(port):
-    httpd = BaseHTTPServer.HTTPServer(('', port), ConnectorRequestHandler)
+    daemon_threads = True
+    allow_keepalive = True
 
-    print('Connector v' + __version__ + ' serving directory:\n' + os.getcwd() + '\nat port ' + str(port))
-    httpd.serve_forever()
+    def __init__(self, server_address, RequestHandlerClass, workers, max_in_flight):
+        self.request_queue_size = max_in_flight
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.pending_requests = Queue.Queue()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # The workers waiting for a new connection, and the wakeup pipes of
+        # the ones waiting for the next request of their connection.
+        self.workers_lock = threading.Lock()
+        self.free_workers = 0
+        self.idle_workers = collections.deque()
+        self.worker = threading.local()
+        # Some of the workers, never all of them, may wait for the changes of
+        # the files (see route_get_events).
+        self.event_stream_slots = threading.BoundedSemaphore(
+            max(0, min(setting('events_max_streams'), workers - 1)))
+        self.worker_threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.process_pending_requests,
+                                      name='glarkconnector-worker-%d' % i)
+            thread.daemon = self.daemon_threads
+            thread.start()
+            self.worker_threads.append(thread)
 
+    def process_request(self, request, client_address):
+        """Queue the request for the workers, or reject it if the server is
+        already busy enough."""
+        if not self.in_flight.acquire(False):
+            self.reject_request(request)
+            self.shutdown_request(request)
+            return
+        with self.workers_lock:
+            self.pending_requests.put((request, client_address))
+            self.wakeup_idle_worker()
 
-def main():
-    global CONFIG
-    port = 3000
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
+    def process_pending_requests(self):
+        """Worker loop: serve the queued requests forever."""
+        self.worker.wakeup_reader, self.worker.wakeup_writer = os.pipe()
+        while True:
+            with self.workers_lock:
+                self.free_workers += 1
+            request, client_address = self.pending_requests.get()
+            with self.workers_lock:
+                self.free_workers -= 1
+                self.wakeup_idle_worker()
+            try:
+                self.serve_connection(request, client_address)
+            finally:
+                self.in_flight.release()
 
-    # Greetings.
-    print(r"""
-            .__                __        .__
-       ____ |  | _____ _______|  | __    |__| ____
-      / ___\|  | \__  \\_  __ \  |/ /    |  |/  _ \
-     / /_/  >  |__/ __ \|  | \/    <     |  (  <_> )
-     \___  /|____(____  /__|  |__|_ \ /\ |__|\____/
-    /_____/           \/           \/ \/
-            """)
+    def wakeup_idle_worker(self):
+        """Make the longest idle worker give its connection up if queued
+        connections are left without a worker. Called with workers_lock."""
+        if self.idle_workers and self.pending_requests.qsize() > self.free_workers:
+            os.write(self.idle_workers.popleft(), 'x')
 
-    if exist_conf_file():
-        with open(CONFIGURATION_FILENAME) as fp:
-            CONFIG = json.load(fp)
-    else:
-        print("There is no '" + CONFIGURATION_FILENAME + "' configuration file in this directory yet.\n"
-                "This might be the first time that you glarkconnect this directory.\n"
-                "Please enter a username and password that will be required\n"
-                "to access this connector from the glark.io editor.\n"
-                "If you want to change these, simply delete the " + CONFIGURATION_FILENAME +
-                "\nthat will be created in this directory.")
-        username = raw_input('Username:')
+    def wait_for_request(self, connection, timeout):
+        """Wait until the next request of a kept-alive connection arrives.
 
-        ask_again = True
-        while ask_again:
-            password1 = getpass.getpass('Password:')
-            password2 = getpass.getpass('Re-enter Password:')
-            if password1 == password2:
-                ask_again = False
+        Return False if it did not arrive within timeout seconds, or if the
+        worker is needed for a queued connection."""
+        wakeup_reader, wakeup_writer = self.worker.wakeup_reader, self.worker.wakeup_writer
+        with self.workers_lock:
+            if self.pending_requests.qsize() > self.free_workers:
+                return False
+            self.idle_workers.append(wakeup_writer)
+        try:
+            readable = select.select([connection, wakeup_reader], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        with self.workers_lock:
+            if wakeup_writer in self.idle_workers:
+                self.idle_workers.remove(wakeup_writer)
             else:
-                print("Passwords do not match. Please try again.")
+                os.read(wakeup_reader, 1)
+        return connection in readable
 
-        # Build the config object and dump it to config file.
-        realm = base64.b64encode(username + ':' + password1)
-        authentication_string = 'Basic ' + realm
-        CONFIG['authentication_string'] = authentication_string
+    def serve_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
-        with open(CONFIGURATION_FILENAME, 'w') as fp:
-            json.dump(CONFIG, fp)
+    def reject_request(self, request):
+        """Answer a 503 on the raw socket, without reading the request."""
+        jsend = json.dumps({'status': 'failure', 'data': 'Server overloaded'})
+        response = ('HTTP/1.0 503 Service Unavailable\r\n'
+                    'Retry-After: 1\r\n'
+                    'Content-type: text/json; charset=%s\r\n'
+                    'Content-Length: %d\r\n'
+                    '\r\n%s') % (sys.getfilesystemencoding(), len(jsend), jsend)
+        try:
+            request.sendall(response)
+        except socket.error:
+            pass
+
+
+class Poller(object):
+    """Minimal readiness notifier over file descriptors, using epoll where
+    available and select elsewhere."""
+
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self.fds = set()
+
+    def register(self, fd):
+        if self.epoll is not None:
+            self.epoll.register(fd, select.EPOLLIN)
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        if self.epoll is not None:
+            self.epoll.unregister(fd)
+        self.fds.discard(fd)
+
+    def poll(self, timeout):
+        """Return the registered fds ready for reading."""
+        try:
+            if self.epoll is not None:
+                return [fd for fd, _ in self.epoll.poll(timeout)]
+            else:
+                return select.select(list(self.fds), [], [], timeout)[0]
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class _UnclosableFile(object):
+    """File proxy whose close() only flushes."""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def close(self):
+        self.fp.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class PersistentConnection(object):
+    """Accepted socket kept open across the requests of a connection.
+
+    The handlers get the same buffered reader for every request, so that the
+    bytes of a pipelined request already read from the socket are not lost in
+    between two requests."""
+
+    def __init__(self, sock, client_address):
+        self.socket = sock
+        self.client_address = client_address
+        self.rfile = sock.makefile('rb', -1)
+        self.last_activity = time.time()
+        self.requests_served = 0
+
+    def makefile(self, mode='r', bufsize=-1):
+        if 'r' in mode:
+            return _UnclosableFile(self.rfile)
+        else:
+            return self.socket.makefile(mode, bufsize)
+
+    def has_buffered_input(self):
+        """Has the next request already been read ahead from the socket?"""
+        # socket._fileobject only keeps the unread bytes in its _rbuf buffer.
+        return self.rfile._rbuf.tell() > 0
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class EventedHTTPServer(ThreadPoolHTTPServer):
+    """HTTP server multiplexing all its open connections in a single event
+    loop.
+
+    An idle connection costs no thread: it waits in the loop until its next
+    request arrives. The request is then handed to the pool of worker threads,
+    which run the handler and its blocking filesystem work, and the connection
+    comes back to the loop once answered."""
+
+    one_request_per_dispatch = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers, max_in_flight, idle_timeout):
+        ThreadPoolHTTPServer.__init__(self, server_address, RequestHandlerClass, workers, max_in_flight)
+        self.socket.setblocking(0)
+        self.idle_timeout = idle_timeout
+        self.idle_connections = {}
+        self.resumed_connections = Queue.Queue()
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        self.poller = Poller()
+        self.poller.register(self.fileno())
+        self.poller.register(self.wakeup_reader)
+        self.serving = False
+
+    def serve_forever(self, poll_interval=0.5):
+        self.serving = True
+        last_expiry = time.time()
+        while self.serving:
+            for fd in self.poller.poll(poll_interval):
+                if fd == self.fileno():
+                    self.accept_connections()
+                elif fd == self.wakeup_reader:
+                    os.read(self.wakeup_reader, 4096)
+                    self.resume_connections()
+                elif fd in self.idle_connections:
+                    self.poller.unregister(fd)
+                    self.dispatch(self.idle_connections.pop(fd))
+
+            if time.time() - last_expiry > 1:
+                self.close_idle_connections()
+                last_expiry = time.time()
+
+    def shutdown(self):
+        self.serving = False
+        self.wakeup()
+
+    def wakeup(self):
+        """Interrupt the event loop."""
+        os.write(self.wakeup_writer, 'x')
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.handle_error(None, None)
+                return
+            if self.verify_request(sock, client_address):
+                self.park(PersistentConnection(sock, client_address))
+            else:
+                self.shutdown_request(sock)
+
+    def park(self, connection):
+        """Let the connection wait for its next request in the event loop."""
+        connection.last_activity = time.time()
+        self.idle_connections[connection.fileno()] = connection
+        self.poller.register(connection.fileno())
+
+    def dispatch(self, connection):
+        """Hand a connection with a pending request to the workers."""
+        if not self.in_flight.acquire(False):
+            self.reject_request(connection.socket)
+            self.shutdown_request(connection)
+            return
+        self.pending_requests.put((connection, connection.client_address))
+
+    def resume_connections(self):
+        """Take back the connections answered by the workers."""
+        while True:
+            try:
+                connection = self.resumed_connections.get_nowait()
+            except Queue.Empty:
+                return
+            if connection.has_buffered_input():
+                self.dispatch(connection)
+            else:
+                self.park(connection)
+
+    def close_idle_connections(self):
+        deadline = time.time() - self.idle_timeout
+        for fd, connection in self.idle_connections.items():
+            if connection.last_activity < deadline:
+                self.poller.unregister(fd)
+                del self.idle_connections[fd]
+                self.shutdown_request(connection)
+
+    def serve_connection(self, connection, client_address):
+        """Serve one request of the connection, then give the connection back
+        to the event loop if it is to be kept alive."""
+        keep_alive = False
+        try:
+            handler = self.RequestHandlerClass(connection, client_address, self)
+            keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(connection, client_address)
+
+        if keep_alive:
+            self.resumed_connections.put(connection)
+            self.wakeup()
+        else:
+            self.shutdown_request(connection)
+
+
+class PreforkHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTP server forking worker processes that all accept connections on the
+    same listening socket.
+
+    Each worker serves one connection at a time; the parent process only
+    restarts the workers that die. A worker waiting for the next request of a
+    kept-alive connection gives the connection up when a new connection is
+    left waiting for a worker.
+
+    The connections waiting for a worker are left in the backlog of the
+    listening socket, of max_in_flight connections: the others are refused or
+    delayed by the kernel rather than answered with a 503."""
+
+    allow_keepalive = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers, max_in_flight):
+        self.request_queue_size = max_in_flight
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        # Let the idle workers race for the connections without blocking in
+        # accept() when another worker won.
+        self.socket.setblocking(0)
+        self.workers = workers
+        self.children = set()
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            while True:
+                while len(self.children) < self.workers:
+                    self.spawn_worker(poll_interval)
+                pid, _ = os.wait()
+                self.children.discard(pid)
+        finally:
+            self.stop_workers()
+
+    def spawn_worker(self, poll_interval):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+
+        # In the worker process.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+        finally:
+            close_access_log()
+            os._exit(0)
+
+    def wait_for_request(self, connection, timeout):
+        """Wait until the next request of a kept-alive connection arrives.
+
+        Return False if it did not arrive within timeout seconds, or if a new
+        connection was not accepted by another worker in the meantime."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                readable = select.select([connection, self.socket], [], [],
+                                         max(0, deadline - time.time()))[0]
+                if connection in readable:
+                    return True
+                elif readable:
+                    # Give the idle workers some time to accept it.
+                    if select.select([connection], [], [], 0.05)[0]:
+                        return True
+                    elif select.select([self.socket], [], [], 0)[0]:
+                        return False
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        return False
+
+    def stop_workers(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children.clear()
+
+
+class InotifyWatcher(object):
+    """Watch directories for changes of their entries with the Linux inotify
+    api, called through ctypes.
+
+    The listeners are called from the watcher thread with the kind of change
+    ('create', 'delete' or 'modify'), the path of the changed entry and
+    whether it is a directory. Renamings are reported as a deletion followed
+    by a creation. A None kind means that events were lost: everything must be
+    considered changed."""
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = (IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        """Raise OSError if inotify is not available."""
+        library = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or library is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.paths = {}
+        self.descriptors = {}
+        self.listeners = []
+        thread = threading.Thread(target=self.read_events, name='glarkconnector-inotify')
+        thread.daemon = True
+        thread.start()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def watch(self, directory):
+        """Start watching the entries of directory, a real path.
+
+        Return False if the directory cannot be watched, including when it is
+        a symlink or it is watched under another path already."""
+        if isinstance(directory, unicode):
+            # ctypes would pass a wide string.
+            directory = directory.encode(sys.getfilesystemencoding())
+        with self.lock:
+            if directory in self.descriptors:
+                return True
+            descriptor = self.libc.inotify_add_watch(self.fd, directory, self.WATCH_MASK)
+            if descriptor < 0 or descriptor in self.paths:
+                return False
+            self.paths[descriptor] = directory
+            self.descriptors[directory] = descriptor
+            return True
+
+    def is_watched(self, directory):
+        return directory in self.descriptors
+
+    def forget(self, directory):
+        """Stop watching directory and all the directories under it."""
+        prefix = directory + os.sep
+        with self.lock:
+            for path, descriptor in self.descriptors.items():
+                if path == directory or path.startswith(prefix):
+                    self.libc.inotify_rm_watch(self.fd, descriptor)
+                    del self.descriptors[path]
+                    self.paths.pop(descriptor, None)
+
+    def read_events(self):
+        """Watcher thread: dispatch the events as they come."""
+        while True:
+            try:
+                select.select([self.fd], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.sync()
+
+    def sync(self):
+        """Dispatch the events already queued by the kernel.
+
+        Calling this before trusting a cached state guarantees that the
+        changes made before the call are taken into account, even if the
+        watcher thread did not wake up yet."""
+        with self.read_lock:
+            while True:
+                try:
+                    buf = os.read(self.fd, 64 * 1024)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    elif e.errno == errno.EAGAIN:
+                        return
+                    raise
+                offset = 0
+                while offset < len(buf):
+                    descriptor, mask, _, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+                    offset += self.EVENT_HEADER.size
+                    name = buf[offset:offset + name_len].rstrip('\0')
+                    offset += name_len
+                    self.dispatch(descriptor, mask, name)
+
+    def dispatch(self, descriptor, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            self.notify(None, None, None)
+            return
+
+        directory = self.paths.get(descriptor)
+        if directory is None:
+            return
+        is_dir = bool(mask & self.IN_ISDIR)
+
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+            # The path of the watch is no longer valid.
+            self.forget(directory)
+            self.notify('delete', directory, True)
+        elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            self.notify('create', os.path.join(directory, name), is_dir)
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            path = os.path.join(directory, name)
+            if is_dir:
+                self.forget(path)
+            self.notify('delete', path, is_dir)
+        elif mask & self.IN_MODIFY:
+            self.notify('modify', os.path.join(directory, name), is_dir)
+
+    def notify(self, kind, path, is_dir):
+        for listener in self.listeners:
+            try:
+                listener(kind, path, is_dir)
+            except Exception:
+                pass
+
+
+class ProcessLocal(object):
+    """Object built on first use, and built again in the forked worker
+    processes, since the threads it might have started do not survive a
+    fork."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.value = None
+        self.pid = None
+        self.lock = threading.RLock()
+
+    def get(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.value = self.factory()
+                    self.pid = os.getpid()
+        return self.value
+
+    def peek(self):
+        """Return the object if it was built in this process, else None."""
+        if self.pid != os.getpid():
+            return None
+        return self.value
+
+
+def make_filesystem_watcher():
+    """Return an InotifyWatcher, or None if the filesystem cannot be
+    watched."""
+    if not setting('use_inotify'):
+        return None
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        return None
+
+
+FILESYSTEM_WATCHER = ProcessLocal(make_filesystem_watcher)
+
+
+class ListingCache(object):
+    """LRU cache of directory listings, keyed by the real path of the
+    directories.
+
+    A listing is dropped as soon as the watcher reports a change in its
+    directory. Without watcher, every hit is checked against the modification
+    time of the directory instead."""
+
+    # A directory modified less than this many seconds before its listing
+    # might be modified again within the same mtime tick: do not cache it.
+    RACY_DELAY = 2
+
+    def __init__(self, max_entries, watcher=None, ignore=None):
+        self.max_entries = max_entries
+        self.watcher = watcher
+        self.ignore = ignore
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        if watcher is not None:
+            watcher.add_listener(self.on_change)
+
+    def list(self, directory):
+        """Return the (name, is_file) pairs of the entries of directory, a
+        real path."""
+        watched = self.watcher is not None and self.watcher.watch(directory)
+        if watched:
+            self.watcher.sync()
+        with self.lock:
+            entry = self.entries.get(directory)
+            invalidations = self.invalidations
+        mtime = None if watched else os.stat(directory).st_mtime
+        if entry is not None and entry[0] == mtime:
+            with self.lock:
+                self.hits += 1
+                if directory in self.entries:
+                    del self.entries[directory]
+                    self.entries[directory] = entry
+            return entry[1]
+
+        listing = scan_directory(directory, self.ignore)
+
+        with self.lock:
+            self.misses += 1
+            # Do not cache a listing that a concurrent change might have
+            # made stale already.
+            if watched and invalidations != self.invalidations:
+                return listing
+            if not watched and time.time() - mtime < self.RACY_DELAY:
+                return listing
+            self.entries.pop(directory, None)
+            self.entries[directory] = (None if watched else mtime, listing)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return listing
+
+    def on_change(self, kind, path, is_dir):
+        if kind == 'modify':
+            return
+        with self.lock:
+            self.invalidations += 1
+            if kind is None:
+                self.entries.clear()
+                return
+            self.entries.pop(os.path.dirname(path), None)
+            if is_dir:
+                prefix = path + os.sep
+                for directory in self.entries.keys():
+                    if directory == path or directory.startswith(prefix):
+                        del self.entries[directory]
+
+
+LISTING_CACHE = ProcessLocal(lambda: ListingCache(setting('listing_cache_size'),
+                                                  FILESYSTEM_WATCHER.get(), IGNORE_MATCHER.get()))
+
+
+def list_directory(directory):
+    """Return the (name, is_file) pairs of the entries of directory, a real
+    path, from the listing cache if enabled. The ignored entries are left
+    out."""
+    if setting('listing_cache_size') <= 0:
+        return scan_directory(directory, IGNORE_MATCHER.get())
+    return LISTING_CACHE.get().list(directory)
+
+
+class PathAuthorizer(object):
+    """Resolve the requested paths, and tell the ones that must not be served:
+    the paths out of the root directory and the blacklisted files.
+
+    The root and the blacklist are resolved once. Resolving a path without
+    symlinks under the root is memoized while the watcher watches all the
+    directories leading to it, since any new symlink on the way is reported.
+    The other paths are resolved on every call."""
+
+    MAX_ENTRIES = 16384
+
+    def __init__(self, root, blacklist, watcher=None):
+        self.root = os.path.realpath(root)
+        self.blacklist = frozenset(os.path.realpath(os.path.join(self.root, path))
+                                   for path in blacklist)
+        self.watcher = watcher
+        self.resolved = set()
+        self.lock = threading.Lock()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        if watcher is not None:
+            watcher.add_listener(self.on_change)
+
+    def resolve(self, path):
+        """Return the real path of path, relative to the current directory."""
+        path = os.path.abspath(path)
+        if self.watcher is None or not is_subpath(path, self.root):
+            return os.path.realpath(path)
+
+        self.watcher.sync()
+        with self.lock:
+            if path in self.resolved:
+                return path
+            invalidations = self.invalidations
+
+        # Watch before resolving, so that no change goes unnoticed.
+        directory = os.path.dirname(path)
+        while is_subpath(directory, self.root):
+            if not self.watcher.watch(directory):
+                return os.path.realpath(path)
+            if directory == self.root:
+                break
+            directory = os.path.dirname(directory)
+
+        real_path = os.path.realpath(path)
+        if real_path == path:
+            with self.lock:
+                if invalidations == self.invalidations:
+                    if len(self.resolved) >= self.MAX_ENTRIES:
+                        self.resolved.clear()
+                    self.resolved.add(path)
+        return real_path
+
+    def is_blacklisted(self, real_path):
+        return real_path in self.blacklist
+
+    def on_change(self, kind, path, is_dir):
+        if kind == 'modify':
+            return
+        with self.lock:
+            self.invalidations += 1
+            if kind is None:
+                self.resolved.clear()
+                return
+            # Only the paths through the changed entry may now lead to a
+            # symlink.
+            self.resolved.difference_update([resolved for resolved in self.resolved
+                                             if is_subpath(resolved, path)])
+
+
+PATH_AUTHORIZER = ProcessLocal(lambda: PathAuthorizer(os.getcwd(), BLACKLISTED_FILES,
+                                                      FILESYSTEM_WATCHER.get()))
+
+
+def resolve_path(path):
+    """Return the real path of path, memoized by the path authorizer."""
+    return PATH_AUTHORIZER.get().resolve(path)
+
+
+def is_subpath(path, directory):
+    """Check that path is directory or under it, both being normalized
+    absolute paths."""
+    if path == directory:
+        return True
+    return path.startswith(directory if directory.endswith(os.sep) else directory + os.sep)
+
+
+def scan_directory(directory, ignore=None):
+    """Return the (name, is_file) pairs of the entries of directory, but the
+    ones ignored by ignore, an IgnoreMatcher.
+
+    With os.scandir, the type of most entries comes from the directory
+    entries themselves, without a stat per entry. Otherwise the entries
+    ignored whatever their type are left out without being stat'ed."""
+    relative_dir = None if ignore is None else ignore.relative_path(directory)
+    scandir = getattr(os, 'scandir', None)
+    if relative_dir is None:
+        if scandir is not None:
+            return [(entry.name, entry.is_file()) for entry in scandir(directory)]
+        return [(name, os.path.isfile(os.path.join(directory, name)))
+                for name in os.listdir(directory)]
+
+    listing = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            is_file = entry.is_file()
+            if not ignore.is_ignored(os.path.join(relative_dir, entry.name), not is_file):
+                listing.append((entry.name, is_file))
+        return listing
+    for name in os.listdir(directory):
+        relative_path = os.path.join(relative_dir, name)
+        if ignore.is_ignored(relative_path, False) and ignore.is_ignored(relative_path, True):
+            continue
+        is_file = os.path.isfile(os.path.join(directory, name))
+        if not ignore.is_ignored(relative_path, not is_file):
+            listing.append((name, is_file))
+    return listing
+
+
+def walk_tree(directory, authorizer, ignore=None):
+    """Generate the (path, is_file, file_stat) of the entries under
+    directory, a real path, but the ones ignored by ignore. The symlinks are
+    not followed, and the blacklisted directories are not walked."""
+    directories = [directory]
+    while directories:
+        directory = directories.pop()
+        try:
+            listing = scan_directory(directory, ignore)
+        except OSError:
+            continue
+        for name, is_file in listing:
+            path = os.path.join(directory, name)
+            try:
+                file_stat = os.lstat(path)
+            except OSError:
+                continue
+            yield path, is_file, file_stat
+            # Do not follow the symlinks, which might loop.
+            if stat.S_ISDIR(file_stat.st_mode) and not authorizer.is_blacklisted(path):
+                directories.append(path)
+
+
+class IgnoreMatcher(object):
+    """Matcher of gitignore style patterns, compiled into a single regular
+    expression per kind of entry.
+
+    The patterns support '*', '?', '[...]' and '**'. A pattern containing a
+    '/' other than a trailing one is anchored to the root directory, otherwise
+    it matches the entries of any directory. A trailing '/' only matches the
+    directories, and a leading '!' includes again the paths matched by other
+    patterns. Ignoring a directory ignores everything under it, since it is
+    never walked."""
+
+    def __init__(self, root, patterns):
+        self.root = root
+        ignored = {False: [], True: []}
+        included = {False: [], True: []}
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            regexes = ignored
+            if pattern.startswith('!'):
+                regexes = included
+                pattern = pattern[1:]
+            directories_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            regex = self.translate(pattern)
+            regexes[True].append(regex)
+            if not directories_only:
+                regexes[False].append(regex)
+        self.ignored = dict((is_dir, self.compile(regexes)) for is_dir, regexes in ignored.items())
+        self.included = dict((is_dir, self.compile(regexes)) for is_dir, regexes in included.items())
+
+    @staticmethod
+    def translate(pattern):
+        """Return the regular expression equivalent to pattern."""
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        regex = ''
+        index = 0
+        while index < len(pattern):
+            if pattern.startswith('**/', index) and (index == 0 or pattern[index - 1] == '/'):
+                regex += '(?:.*/)?'
+                index += 3
+            elif pattern.startswith('/**', index) and index + 3 == len(pattern):
+                regex += '/.*'
+                index += 3
+            elif pattern.startswith('**', index):
+                regex += '.*'
+                index += 2
+            elif pattern[index] == '*':
+                regex += '[^/]*'
+                index += 1
+            elif pattern[index] == '?':
+                regex += '[^/]'
+                index += 1
+            elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+                end = pattern.index(']', index + 2)
+                characters = pattern[index + 1:end]
+                if characters.startswith('!'):
+                    characters = '^' + characters[1:]
+                regex += '[' + characters + ']'
+                index = end + 1
+            elif pattern[index] == '\\' and index + 1 < len(pattern):
+                regex += re.escape(pattern[index + 1])
+                index += 2
+            else:
+                regex += re.escape(pattern[index])
+                index += 1
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        return regex
+
+    @staticmethod
+    def compile(regexes):
+        if not regexes:
+            return None
+        return re.compile('(?:%s)\\Z' % '|'.join('(?:%s)' % regex for regex in regexes))
+
+    def relative_path(self, path):
+        """Return the path of path relative to the root, or None if path is
+        not under the root."""
+        if path == self.root:
+            return ''
+        elif is_subpath(path, self.root):
+            return path[len(self.root.rstrip(os.sep)) + 1:]
+        return None
+
+    def is_ignored(self, relative_path, is_dir):
+        """Is the entry at relative_path, relative to the root, ignored?"""
+        ignored = self.ignored[is_dir]
+        if ignored is None or ignored.match(relative_path) is None:
+            return False
+        included = self.included[is_dir]
+        return included is None or included.match(relative_path) is None
+
+
+class EventHub(object):
+    """Changes of the files of the served tree, for the events route.
+
+    The changes reported by the watcher, or by scanning the tree every few
+    seconds if it cannot be watched, are coalesced by path: a path changed
+    several times gets a single event. They are published once no change came
+    for a short while, or after some time even if changes keep coming.
+
+    The events are identified by the token of the hub and a sequence number,
+    and the last ones are kept for the clients to catch up. A client asking
+    for events that are not known anymore, or from another hub, gets a
+    'reset' event instead."""
+
+    HISTORY_SIZE = 1024
+
+    def __init__(self, authorizer, watcher=None, ignore=None):
+        self.root = authorizer.root
+        self.authorizer = authorizer
+        self.watcher = watcher
+        self.ignore = ignore
+        self.token = '%x.%x' % (os.getpid(), int(time.time() * 1000000))
+        self.sequence = 0
+        self.history = collections.deque(maxlen=self.HISTORY_SIZE)
+        self.pending = collections.OrderedDict()
+        self.pending_reset = False
+        self.new_directories = []
+        self.first_change = None
+        self.last_change = None
+        self.condition = threading.Condition()
+        self.started = False
+
+    def start(self):
+        """Start watching the tree, if not already done."""
+        # The changes are reported from the return on, as the events
+        # following the last id the caller gets must include them.
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+            snapshot = None
+            if self.watcher is not None:
+                self.watcher.add_listener(self.on_change)
+                self.watch_tree(self.root, False)
+            else:
+                snapshot = self.scan_tree(None)
+            thread = threading.Thread(target=self.run, args=(snapshot,), name='glarkconnector-events')
+            thread.daemon = True
+            thread.start()
+
+    def last_id(self):
+        return '%s-%d' % (self.token, self.sequence)
+
+    def wait(self, since, timeout):
+        """Return the (id, event) pairs following the since id and the last
+        id, waiting up to timeout seconds for events if there are none yet."""
+        self.start()
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                events = self.events_since(since)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events, self.last_id()
+                self.condition.wait(remaining)
+
+    def events_since(self, since):
+        token, _, sequence = since.partition('-')
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            sequence = -1
+        oldest = self.history[0][0] if self.history else self.sequence + 1
+        if token != self.token or not oldest - 1 <= sequence <= self.sequence:
+            return [(self.last_id(), {'kind': 'reset'})]
+        return [('%s-%d' % (self.token, event_sequence), event)
+                for event_sequence, event in self.history if event_sequence > sequence]
+
+    def changed_paths(self, since):
+        """Return the relative paths changed after the since id, including
+        the changes not published yet, and the last id. The paths are None if
+        the changes are not known."""
+        self.start()
+        if self.watcher is not None:
+            self.watcher.sync()
+        with self.condition:
+            if since is None or self.pending_reset:
+                return None, self.last_id()
+            paths = set(self.pending)
+            for _, event in self.events_since(since):
+                if event['kind'] == 'reset':
+                    return None, self.last_id()
+                paths.add(event['path'])
+            return paths, self.last_id()
+
+    def on_change(self, kind, path, is_dir):
+        with self.condition:
+            if kind is None:
+                self.pending_reset = True
+                self.pending.clear()
+            else:
+                if kind == 'modify' and is_dir:
+                    return
+                relative_path = self.relative_path(path)
+                if relative_path is None or self.is_excluded(path, relative_path, is_dir):
+                    return
+                previous = self.pending.pop(relative_path, None)
+                # A file created then modified is still a new file.
+                if kind == 'modify' and previous is not None and previous[0] == 'create':
+                    kind = 'create'
+                self.pending[relative_path] = (kind, is_dir)
+                if kind == 'create' and is_dir and self.watcher is not None:
+                    self.new_directories.append(path)
+
+            now = time.time()
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.condition.notify_all()
+
+    def relative_path(self, path):
+        if is_subpath(path, self.root) and path != self.root:
+            return path[len(self.root.rstrip(os.sep)) + 1:]
+        return None
+
+    def is_excluded(self, path, relative_path, is_dir):
+        if self.authorizer.is_blacklisted(path) or STAGED_FILE_NAME.match(os.path.basename(path)):
+            return True
+        if self.ignore is None:
+            return False
+        if self.ignore.is_ignored(relative_path, is_dir):
+            return True
+        # The ignored directories are not watched, but they might be listed.
+        directory = os.path.dirname(relative_path)
+        while directory:
+            if self.ignore.is_ignored(directory, True):
+                return True
+            directory = os.path.dirname(directory)
+        return False
+
+    def watch_tree(self, directory, announce):
+        """Watch directory and its subdirectories. If announce, report their
+        entries as created, since they might have been before the watches."""
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            if not self.watcher.watch(directory):
+                continue
+            try:
+                listing = scan_directory(directory, self.ignore)
+            except OSError:
+                continue
+            for name, is_file in listing:
+                path = os.path.join(directory, name)
+                if announce:
+                    self.on_change('create', path, not is_file)
+                if not is_file and not self.authorizer.is_blacklisted(path):
+                    directories.append(path)
+
+    def run(self, snapshot):
+        """Publish the changes as they settle, scanning the tree from
+        snapshot on if it is not watched."""
+        while True:
+            with self.condition:
+                if not self.pending and not self.pending_reset and not self.new_directories:
+                    self.condition.wait(setting('events_poll_interval') if self.watcher is None else None)
+            if self.watcher is None:
+                snapshot = self.scan_tree(snapshot)
+            with self.condition:
+                new_directories, self.new_directories = self.new_directories, []
+
+            for directory in new_directories:
+                self.watch_tree(directory, True)
+
+            with self.condition:
+                while self.first_change is not None:
+                    publication = min(self.last_change + setting('events_debounce'),
+                                      self.first_change + setting('events_max_delay'))
+                    if time.time() >= publication or self.new_directories:
+                        break
+                    self.condition.wait(publication - time.time())
+                if self.first_change is not None and not self.new_directories:
+                    self.publish()
+
+    def publish(self):
+        """Turn the pending changes into events. Must be called with the
+        condition held."""
+        if self.pending_reset:
+            self.sequence += 1
+            self.history.append((self.sequence, {'kind': 'reset'}))
+        for relative_path, (kind, is_dir) in self.pending.iteritems():
+            self.sequence += 1
+            self.history.append((self.sequence, {'kind': kind, 'path': relative_path,
+                                                 'type': 'dir' if is_dir else 'file'}))
+        self.pending.clear()
+        self.pending_reset = False
+        self.first_change = self.last_change = None
+        self.condition.notify_all()
+
+    def scan_tree(self, snapshot):
+        """Report the differences between the tree and its previous snapshot,
+        and return its new snapshot."""
+        current = {}
+        for path, is_file, file_stat in walk_tree(self.root, self.authorizer, self.ignore):
+            current[path] = (is_file, file_stat.st_mtime, file_stat.st_size)
+
+        if snapshot is not None:
+            # In path order, so that the directories are created before their
+            # entries and deleted after them, as the watcher would report.
+            for path in sorted(current):
+                previous, state = snapshot.get(path), current[path]
+                if previous is None:
+                    self.on_change('create', path, not state[0])
+                elif previous != state and state[0]:
+                    self.on_change('modify', path, False)
+            for path in sorted(snapshot, reverse=True):
+                if path not in current:
+                    self.on_change('delete', path, not snapshot[path][0])
+        return current
+
+
+def make_ignore_matcher():
+    """Return the IgnoreMatcher of the configured patterns, or None if
+    nothing is ignored."""
+    if not setting('ignore'):
+        return None
+    return IgnoreMatcher(os.path.realpath(os.getcwd()), setting('ignore'))
+
+
+IGNORE_MATCHER = ProcessLocal(make_ignore_matcher)
+EVENT_HUB = ProcessLocal(lambda: EventHub(PATH_AUTHORIZER.get(), FILESYSTEM_WATCHER.get(),
+                                          IGNORE_MATCHER.get()))
+
+
+class TreeWalk(object):
+    """Depth first walk of a directory tree, in name order, producing the
+    tree in pages of at most limit entries.
+
+    The pages are delimited by the path of the last entry of the previous
+    page, as a tuple of path components: in a depth first walk in name order,
+    the entries come in the order of these tuples."""
+
+    def __init__(self, root, is_excluded, limit, after=None):
+        self.root = root
+        self.is_excluded = is_excluded
+        self.limit = limit
+        self.after = after
+        self.count = 0
+        self.last = None
+        self.truncated = False
+
+    def walk(self, directory, relative_dir, depth, ancestors):
+        """Generate the entries of directory, a real path whose path relative
+        to the root is relative_dir, and of its subdirectories down to depth.
+
+        The children of a directory entry are a generator too, which must be
+        exhausted before the next entry is generated."""
+        try:
+            listing = sorted(list_directory(directory))
+        except os.error:
+            return
+
+        for name, is_file in listing:
+            if self.truncated:
+                return
+            path = os.path.join(directory, name)
+            if self.is_excluded(path):
+                continue
+
+            relative_path = os.path.join(relative_dir, name)
+            components = tuple(relative_path.split(os.sep))
+            if self.after is not None and components <= self.after:
+                if is_file or self.after[:len(components)] != components:
+                    # Sent in a previous page.
+                    continue
+                entry = {'name': name, 'path': relative_path, 'type': 'dir', 'continued': True}
+            else:
+                if self.count == self.limit:
+                    self.truncated = True
+                    return
+                self.count += 1
+                self.last = components
+                entry = {'name': name, 'path': relative_path, 'type': 'file' if is_file else 'dir'}
+
+            if not is_file and depth > 1:
+                subdirectory = resolve_path(path)
+                # Do not follow the symlinks leading out of the root or into
+                # a loop.
+                if is_subpath(subdirectory, self.root) and subdirectory not in ancestors:
+                    entry['children'] = self.walk(subdirectory, relative_path, depth - 1,
+                                                  ancestors | frozenset([subdirectory]))
+
+            yield entry
+
+
+class StreamedText(object):
+    """String value of a json document read from a file at encoding time,
+    block by block. The file is expected to be encoded in UTF-8."""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+
+class MappedFile(object):
+    """Read only file object over the memory mapping of the file fp, which
+    can be shared by several MappedFile objects.
+
+    Reading a mapping past the end of a truncated file kills the process with
+    a SIGBUS: the size of the file is checked before each read, and fp is
+    read instead once the file is found truncated."""
+
+    def __init__(self, mapping, fp):
+        self.mapping = mapping
+        self.fp = fp
+        self.position = 0
+        self.truncated = False
+
+    def read(self, size):
+        end = min(self.position + size, len(self.mapping))
+        if not self.truncated and os.fstat(self.fp.fileno()).st_size < end:
+            self.truncated = True
+            self.fp.seek(self.position)
+        if self.truncated:
+            data = self.fp.read(size)
+        else:
+            data = self.mapping[self.position:end]
+        self.position += len(data)
+        return data
+
+
+class LateValue(object):
+    """Value of a json document computed at encoding time, once all the
+    values preceding it have been encoded."""
+
+    def __init__(self, compute):
+        self.compute = compute
+
+
+def iter_json(obj):
+    """Encode obj in json, piece by piece.
+
+    Besides the json dumpable types, obj may contain iterators (encoded as
+    arrays), StreamedText and LateValue objects. The output is the same as the
+    one of json.dumps."""
+    if isinstance(obj, dict):
+        if all(isinstance(value, JSON_SCALAR_TYPES) for value in obj.itervalues()):
+            yield json.dumps(obj)
+            return
+        separator = '{'
+        for key, value in obj.iteritems():
+            yield separator + json.dumps(key) + ': '
+            separator = ', '
+            for piece in iter_json(value):
+                yield piece
+        yield '{}' if separator == '{' else '}'
+    elif isinstance(obj, (list, tuple, collections.Iterator)):
+        separator = '['
+        for value in obj:
+            yield separator
+            separator = ', '
+            for piece in iter_json(value):
+                yield piece
+        yield '[]' if separator == '[' else ']'
+    elif isinstance(obj, StreamedText):
+        yield '"'
+        # Decode incrementally so that the characters split between two
+        # blocks are not lost.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            data = obj.fp.read(FILE_CHUNK_SIZE)
+            text = decoder.decode(data, final=not data)
+            yield json.encoder.encode_basestring_ascii(text)[1:-1]
+            if not data:
+                break
+        yield '"'
+    elif isinstance(obj, LateValue):
+        for piece in iter_json(obj.compute()):
+            yield piece
+    else:
+        yield json.dumps(obj)
+
+
+class SizedLRUCache(object):
+    """Thread safe LRU cache holding at most max_size bytes of values."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+
+COMPRESSED_CACHE = ProcessLocal(lambda: SizedLRUCache(setting('compressed_cache_size')))
+CONTENT_CACHE = ProcessLocal(lambda: SizedLRUCache(setting('content_cache_size')))
+
+
+class Metrics(object):
+    """Thread safe counters and latency histograms of the served requests,
+    per route and method, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = collections.defaultdict(int)
+        self.received = collections.defaultdict(int)
+        self.sent = collections.defaultdict(int)
+        # Histograms, as the counts of their buckets followed by the sum of
+        # the observed values.
+        self.durations = {}
+        self.phases = {}
+
+    def record(self, route, method, status, duration, phase_times, received, sent):
+        """Account for a served request, which took duration seconds,
+        phase_times of them in the phases listed in that dict."""
+        key = (route, method)
+        with self.lock:
+            self.requests[key + (str(status),)] += 1
+            self.received[key] += received
+            self.sent[key] += sent
+            self.observe(self.durations, key, duration)
+            for phase, phase_time in phase_times.iteritems():
+                self.observe(self.phases, key + (phase,), phase_time)
+
+    @staticmethod
+    def observe(histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def render(self, caches):
+        """Return the metrics in the Prometheus text format, including the
+        hits and misses of the given (name, cache) pairs."""
+        lines = []
+
+        def add_metric(name, kind, description, samples):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % label for label in labels)
+                lines.append('%s%s%s %s' % (name, suffix, '{%s}' % labels if labels else '', repr(value)))
+
+        def histogram_samples(histograms, names):
+            for key, histogram in sorted(histograms.iteritems()):
+                labels = zip(names, key)
+                count = 0
+                for bound, bucket in zip(METRICS_BUCKETS + ('+Inf',), histogram):
+                    count += bucket
+                    yield '_bucket', labels + [('le', bound)], count
+                yield '_sum', labels, histogram[-1]
+                yield '_count', labels, count
+
+        with self.lock:
+            add_metric('glarkconnector_requests_total', 'counter', 'Requests served.',
+                       [('', zip(('route', 'method', 'status'), key), count)
+                        for key, count in sorted(self.requests.iteritems())])
+            add_metric('glarkconnector_request_duration_seconds', 'histogram',
+                       'Time spent serving the requests, from their parsing.',
+                       histogram_samples(self.durations, ('route', 'method')))
+            add_metric('glarkconnector_request_phase_seconds', 'histogram',
+                       'Time spent in the routing, authentication, authorization, filesystem '
+                       'and serialization phases of the requests.',
+                       histogram_samples(self.phases, ('route', 'method', 'phase')))
+            add_metric('glarkconnector_received_bytes_total', 'counter',
+                       'Bytes of the requests, headers included.',
+                       [('', zip(('route', 'method'), key), size)
+                        for key, size in sorted(self.received.iteritems())])
+            add_metric('glarkconnector_sent_bytes_total', 'counter',
+                       'Bytes of the responses, headers included.',
+                       [('', zip(('route', 'method'), key), size)
+                        for key, size in sorted(self.sent.iteritems())])
+        add_metric('glarkconnector_cache_hits_total', 'counter', 'Values found in the caches.',
+                   [('', [('cache', name)], cache.hits) for name, cache in caches])
+        add_metric('glarkconnector_cache_misses_total', 'counter', 'Values missing from the caches.',
+                   [('', [('cache', name)], cache.misses) for name, cache in caches])
+        add_metric('glarkconnector_start_time_seconds', 'gauge', 'Start time of the process.',
+                   [('', [], self.start_time)])
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = ProcessLocal(Metrics)
+
+
+def route_name(path):
+    """Return the label of the route of the request path, in the metrics."""
+    if path == '/connector':
+        return 'api'
+    match = ROUTE_NAME.match(path)
+    return match.group(1) if match else 'other'
+
+
+class PhaseTimer(object):
+    """Context manager adding the time spent in its block to the given phase
+    of the request served by handler. Of nested phases, only the outermost
+    one counts."""
+
+    __slots__ = ('handler', 'phase', 'start')
+
+    def __init__(self, handler, phase):
+        self.handler = handler
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        if self.handler.current_phase is None:
+            self.handler.current_phase = self.phase
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            phase_times = self.handler.phase_times
+            phase_times[self.phase] = phase_times.get(self.phase, 0.0) + time.time() - self.start
+            self.handler.current_phase = None
+
+
+class CountingFile(object):
+    """Wrapper of the file of a connection, counting the bytes read from it
+    and written to it."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.fp.readline(size)
+        self.count += len(data)
+        return data
+
+    def write(self, data):
+        self.count += len(data)
+        self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class AccessLog(object):
+    """Log of the served requests, written as JSON lines to the file
+    descriptor fd by a background thread, so that the requests never wait for
+    it.
+
+    The successful requests are logged with probability sample_rate. The
+    failed ones are all logged, but at most max_failures per second: the
+    others are only counted, as are the entries dropped when the writer falls
+    behind, and reported in a later line."""
+
+    def __init__(self, fd, sample_rate, max_failures):
+        self.fd = fd
+        self.sample_rate = sample_rate
+        self.max_failures = max_failures
+        self.queue = Queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.failures_second = None
+        self.failures_logged = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='glarkconnector-access-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, fields, failed=False):
+        """Queue an entry made of the given (name, value) pairs."""
+        if failed:
+            second = int(time.time())
+            with self.lock:
+                if second != self.failures_second:
+                    self.failures_second = second
+                    self.failures_logged = 0
+                if self.failures_logged >= self.max_failures:
+                    self.suppressed += 1
+                    return
+                self.failures_logged += 1
+        elif self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), fields))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        closing = False
+        while not closing:
+            entries = []
+            try:
+                entries.append(self.queue.get(timeout=ACCESS_LOG_REPORT_INTERVAL))
+                while len(entries) < ACCESS_LOG_BATCH_SIZE:
+                    entries.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in entries:
+                closing = True
+                entries.remove(None)
+
+            lines = [format_log_entry(timestamp, fields) for timestamp, fields in entries]
+            with self.lock:
+                suppressed, dropped = self.suppressed, self.dropped
+                self.suppressed = self.dropped = 0
+            if suppressed or dropped:
+                lines.append(format_log_entry(time.time(), [
+                    ('message', 'Entries not logged'), ('failures_suppressed', suppressed),
+                    ('entries_dropped', dropped)]))
+            if lines:
+                self.write('\n'.join(lines) + '\n')
+
+    def write(self, data):
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError:
+            # There is nowhere to report it.
+            pass
+
+    def close(self, timeout=1):
+        """Write the queued entries, waiting at most timeout seconds."""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+def format_log_entry(timestamp, fields):
+    """Return the line of the access log made of the given (name, value)
+    pairs, following the time of the entry."""
+    entry = collections.OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) +
+                                      '.%03dZ' % (timestamp * 1000 % 1000))])
+    entry.update(fields)
+    try:
+        return json.dumps(entry)
+    except UnicodeDecodeError:
+        # The paths are not always valid UTF-8.
+        return json.dumps(entry, encoding='latin-1')
+
+
+def make_access_log():
+    """Return the AccessLog of the process, or None if it is disabled."""
+    destination = setting('access_log')
+    if destination is None:
+        return None
+    if destination == '-':
+        fd = sys.stderr.fileno()
+    else:
+        fd = os.open(destination, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666 & ~UMASK)
+    return AccessLog(fd, setting('access_log_sample_rate'), setting('access_log_max_failures'))
+
+
+def close_access_log():
+    """Write the pending entries of the access log of the process."""
+    access_log = ACCESS_LOG.peek()
+    if access_log is not None:
+        access_log.close()
+
+
+ACCESS_LOG = ProcessLocal(make_access_log)
+
+# A file modified less than this many seconds ago might be modified again
+# within the same mtime tick: do not cache its content.
+RACY_FILE_DELAY = 2
+
+
+def make_cache_key(key, file_stat):
+    """Extend key with what identifies the current content of the file, so
+    that the cached values get stale when the file is modified. Return None
+    if the file was modified too recently for its content to be cached."""
+    if time.time() - file_stat.st_mtime < RACY_FILE_DELAY:
+        return None
+    return key + (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime)
+
+
+def open_file_mapping(fp, file_stat):
+    """Return a file object reading the content of fp from a cached memory
+    mapping, or fp itself if the file is not mapped."""
+    if (not setting('content_cache_mmap') or not stat.S_ISREG(file_stat.st_mode) or
+            file_stat.st_size == 0):
+        return fp
+    # Unlike the contents read, a mapping follows the modifications of its
+    # file, so that it only gets stale when the file is replaced or resized.
+    # The MappedFile holds the mapping until the end of the response, even if
+    # it is evicted from the cache meanwhile.
+    key = ('mapping', fp.name, file_stat.st_ino, file_stat.st_size)
+    content_cache = CONTENT_CACHE.get()
+    mapping = content_cache.get(key)
+    if mapping is None:
+        try:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return fp
+        content_cache.put(key, mapping, file_stat.st_size)
+    return MappedFile(mapping, fp)
+
+
+def is_utf8_file(fp):
+    """Is the content of fp, from its current position on, valid UTF-8? fp is
+    read to the end, then moved back."""
+    position = fp.tell()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        while True:
+            data = fp.read(FILE_CHUNK_SIZE)
+            decoder.decode(data, final=not data)
+            if not data:
+                return True
+    except UnicodeDecodeError:
+        return False
+    finally:
+        fp.seek(position)
+
+
+def make_compressor(content_encoding):
+    """Return a zlib compressor producing the given content encoding."""
+    if content_encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+    return zlib.compressobj(setting('compression_level'), zlib.DEFLATED, wbits)
+
+
+def compress(data, content_encoding):
+    compressor = make_compressor(content_encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TaskPool(object):
+    """Fixed pool of threads running functions for the request handlers.
+
+    It is distinct from the threads serving the requests, so that a request
+    never waits for a thread busy waiting for it."""
+
+    def __init__(self, threads):
+        self.tasks = Queue.Queue()
+        for index in range(threads):
+            thread = threading.Thread(target=self.run, name='glarkconnector-task-%d' % index)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            task()
+
+    def map(self, function, items):
+        """Return the list of the function(item), computed in parallel.
+
+        If function raises for some items, the first exception is raised once
+        all the items are done."""
+        results = [None] * len(items)
+        errors = []
+        remaining = [len(items)]
+        lock = threading.Lock()
+        done = threading.Event()
+        if not items:
+            return results
+
+        def make_task(index, item):
+            def task():
+                try:
+                    results[index] = function(item)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    with lock:
+                        remaining[0] -= 1
+                        if remaining[0] == 0:
+                            done.set()
+            return task
+
+        for index, item in enumerate(items):
+            self.tasks.put(make_task(index, item))
+        done.wait()
+        if errors:
+            raise errors[0]
+        return results
+
+
+BATCH_POOL = ProcessLocal(lambda: TaskPool(setting('batch_threads')))
+
+
+class TreeSearch(object):
+    """Search of files by the search processes, stopping after limit matching
+    lines."""
+
+    def __init__(self, pool, pattern, literal, limit):
+        self.pool = pool
+        self.pattern = pattern
+        self.literal = literal
+        self.limit = limit
+        self.count = 0
+        self.truncated = False
+
+    def search(self, files):
+        """Generate the {'path', 'matches'} of the matching files among files,
+        (path, relative_path) pairs, as they are found."""
+        tasks = ((batch, self.pattern, self.literal, self.limit)
+                 for batch in iter_batches(files, SEARCH_BATCH_SIZE))
+        results = imap_pool(self.pool, search_files, tasks)
+        try:
+            for found in results:
+                for relative_path, matches in found:
+                    if self.count + len(matches) >= self.limit:
+                        matches = matches[:self.limit - self.count]
+                        self.truncated = True
+                    self.count += len(matches)
+                    yield {'path': relative_path, 'matches': matches}
+                    if self.truncated:
+                        return
+        except OSError:
+            # A task timed out.
+            self.truncated = True
+        finally:
+            results.close()
+
+
+class SearchIndex(object):
+    """Index of the trigrams of the files of the served tree, telling the
+    files which may hold some strings.
+
+    The trigrams are taken from the lower-cased contents, so that the index
+    serves the case insensitive searches too. The index is saved in a file
+    and kept up to date from the changes reported by the event hub: only the
+    files modified since are indexed again, including after a restart, where
+    their size and modification time tell them."""
+
+    VERSION = 2
+
+    # Seconds between two saves of the index.
+    SAVE_DELAY = 60
+
+    def __init__(self, authorizer, hub, ignore, filename):
+        self.root = authorizer.root
+        self.authorizer = authorizer
+        self.hub = hub
+        self.ignore = ignore
+        self.filename = os.path.join(self.root, filename)
+        # File ids to relative paths, None for the files dropped since.
+        self.paths = []
+        # Relative paths to (file id, mtime, size), the file id being None for
+        # the files which cannot be searched and the mtime None for the files
+        # to index again.
+        self.files = {}
+        # Trigrams to the arrays of the ids of the files holding them.
+        self.postings = {}
+        self.dropped = 0
+        self.since = None
+        self.loaded = False
+        self.saved = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def find(self, literals, pool):
+        """Return the sorted relative paths of the files which may hold all the
+        literals, lower-cased byte strings, or None if the index cannot tell:
+        if the literals are too short, or the index is being built or updated
+        by another search."""
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(TRIGRAM.findall(literal))
+        if not trigrams or not self.lock.acquire(False):
+            return None
+        if not self.loaded:
+            # Indexing all the files takes a while: it is done in the
+            # background, which releases the lock once done.
+            self.loaded = True
+            thread = threading.Thread(target=self.build, args=(pool,), name='glarkconnector-index')
+            thread.daemon = True
+            thread.start()
+            return None
+        try:
+            if not self.update(pool):
+                return None
+            file_ids = None
+            for trigram in sorted(trigrams, key=lambda trigram: len(self.postings.get(trigram, ()))):
+                posting = self.postings.get(trigram, ())
+                file_ids = set(posting) if file_ids is None else file_ids.intersection(posting)
+                if not file_ids:
+                    break
+            return sorted(self.paths[file_id] for file_id in file_ids if self.paths[file_id] is not None)
+        finally:
+            self.lock.release()
+
+    def build(self, pool):
+        """Load the saved index, and bring it up to date. Must be called with
+        the lock held, which is released."""
+        try:
+            self.load()
+            self.update(pool)
+        finally:
+            self.lock.release()
+
+    def update(self, pool):
+        """Index the files changed since the last update, or all the files the
+        first time. Return False if some could not be indexed."""
+        paths, last_id = self.hub.changed_paths(self.since)
+        if paths is None:
+            paths = [self.root]
+        else:
+            paths = [os.path.join(self.root, relative_path) for relative_path in paths]
+        stale = []
+        for path in paths:
+            stale.extend(self.refresh(path))
+        try:
+            self.index(stale, pool)
+        except OSError:
+            # A task timed out, the changes are taken again next time.
+            return False
+
+        self.since = last_id
+        if self.dropped > max(len(self.paths) // 2, 1024):
+            self.compact()
+        if self.dirty and time.time() - self.saved >= self.SAVE_DELAY:
+            self.save()
+        return True
+
+    def refresh(self, path):
+        """Drop the indexed files which are no longer path or under it, and
+        return the (path, relative_path, file_stat) of the ones to index."""
+        try:
+            path_stat = os.lstat(path)
+        except OSError:
+            path_stat = None
+        is_dir = path_stat is not None and stat.S_ISDIR(path_stat.st_mode)
+        if is_dir:
+            entries = walk_tree(path, self.authorizer, self.ignore)
+        elif path_stat is not None:
+            entries = [(path, True, path_stat)]
+        else:
+            entries = []
+
+        root = self.root.rstrip(os.sep) + os.sep
+        present = {}
+        for entry_path, _, file_stat in entries:
+            if stat.S_ISREG(file_stat.st_mode) and not self.authorizer.is_blacklisted(entry_path):
+                present[entry_path[len(root):]] = (entry_path, file_stat)
+
+        relative_path = path[len(root):]
+        if not relative_path:
+            previous = list(self.files)
+        elif relative_path in self.files and not is_dir:
+            previous = [relative_path]
+        else:
+            previous = [indexed for indexed in self.files if is_subpath(indexed, relative_path)]
+        for indexed in previous:
+            if indexed not in present:
+                self.drop(indexed)
+
+        stale = []
+        for entry_relative_path, (entry_path, file_stat) in present.iteritems():
+            entry = self.files.get(entry_relative_path)
+            if entry is None or entry[1:] != (file_stat.st_mtime, file_stat.st_size):
+                stale.append((entry_path, entry_relative_path, file_stat))
+        return stale
+
+    def index(self, stale, pool):
+        """Index the stale files, (path, relative_path, file_stat) tuples."""
+        stats = {}
+        files = []
+        for path, relative_path, file_stat in stale:
+            if file_stat.st_size > setting('search_max_file_size'):
+                self.add(relative_path, file_stat, None)
+            else:
+                stats[relative_path] = file_stat
+                files.append((path, relative_path))
+        for results in imap_pool(pool, index_files, iter_batches(files, SEARCH_BATCH_SIZE)):
+            for relative_path, trigrams in results:
+                self.add(relative_path, stats[relative_path], trigrams)
+
+    def add(self, relative_path, file_stat, trigrams):
+        """Index a file, given the concatenation of its trigrams, or None if
+        it cannot be searched."""
+        self.drop(relative_path)
+        mtime = file_stat.st_mtime
+        if time.time() - mtime < RACY_FILE_DELAY:
+            # It might be modified again within the same mtime tick.
+            mtime = None
+        file_id = None
+        if trigrams is not None:
+            file_id = len(self.paths)
+            self.paths.append(relative_path)
+            for offset in xrange(0, len(trigrams), 3):
+                trigram = trigrams[offset:offset + 3]
+                posting = self.postings.get(trigram)
+                if posting is None:
+                    posting = self.postings[trigram] = array.array('i')
+                posting.append(file_id)
+        self.files[relative_path] = (file_id, mtime, file_stat.st_size)
+        self.dirty = True
+
+    def drop(self, relative_path):
+        entry = self.files.pop(relative_path, None)
+        if entry is None:
+            return
+        if entry[0] is not None:
+            # Its postings are left out by the next compaction.
+            self.paths[entry[0]] = None
+            self.dropped += 1
+        self.dirty = True
+
+    def compact(self):
+        """Number the files again, leaving the dropped ones out."""
+        new_ids = {}
+        paths = []
+        for file_id, relative_path in enumerate(self.paths):
+            if relative_path is not None:
+                new_ids[file_id] = len(paths)
+                paths.append(relative_path)
+        postings = {}
+        for trigram, posting in self.postings.iteritems():
+            posting = array.array('i', [new_ids[file_id] for file_id in posting if file_id in new_ids])
+            if posting:
+                postings[trigram] = posting
+        for relative_path, (file_id, mtime, size) in self.files.items():
+            if file_id is not None:
+                self.files[relative_path] = (new_ids[file_id], mtime, size)
+        self.paths = paths
+        self.postings = postings
+        self.dropped = 0
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                state = json.load(fp)
+            if state['version'] != self.VERSION or state['root'].encode('latin-1') != self.root:
+                return
+            paths = [path if path is None else path.encode('latin-1') for path in state['paths']]
+            files = dict((relative_path.encode('latin-1'), tuple(entry))
+                         for relative_path, entry in state['files'].iteritems())
+            postings = dict((trigram.decode('hex'), array.array('i', base64.b64decode(posting)))
+                            for trigram, posting in state['postings'].iteritems())
+        except Exception:
+            # A missing or damaged index is built again.
+            return
+        self.paths = paths
+        self.files = files
+        self.postings = postings
+        self.saved = time.time()
+
+    def save(self):
+        # The index is saved as json rather than pickled: it is read from the
+        # served tree, and unpickling can run code. The paths, byte strings
+        # in any encoding, are decoded as latin-1 to get them back unchanged.
+        if self.dropped:
+            self.compact()
+        state = {'version': self.VERSION, 'root': self.root, 'paths': self.paths, 'files': self.files,
+                 'postings': dict((trigram.encode('hex'), base64.b64encode(posting.tostring()))
+                                  for trigram, posting in self.postings.iteritems())}
+        try:
+            write_file_atomically(self.filename, [json.dumps(state, encoding='latin-1')])
+        except (IOError, OSError):
+            # The index is built again on the next start.
+            pass
+        self.saved = time.time()
+        self.dirty = False
+
+
+# Matches the trigrams of a byte string, overlapping.
+TRIGRAM = re.compile(r'(?=(...))', re.DOTALL)
+
+
+def make_search_pattern(query, is_regex, ignore_case):
+    """Compile the pattern of a search. Raise re.error if the query is not a
+    valid regular expression."""
+    flags = re.MULTILINE | re.UNICODE
+    if ignore_case:
+        flags |= re.IGNORECASE
+    return re.compile(query if is_regex else re.escape(query), flags)
+
+
+def search_literals(query, pattern, is_regex):
+    """Return lower-cased byte strings that any file matching the search
+    holds."""
+    literals = regex_literals(sre_parse.parse(query, pattern.flags)) if is_regex else [query]
+    encoded = []
+    for literal in literals:
+        literal = literal.encode('utf-8').lower()
+        if pattern.flags & re.IGNORECASE:
+            # Only the ASCII letters are lower-cased in the index.
+            encoded.extend(re.split(r'[\x80-\xff]+', literal))
+        else:
+            encoded.append(literal)
+    return encoded
+
+
+def regex_literals(parsed):
+    """Return strings that any match of a parsed regular expression holds:
+    the runs of literal characters out of the optional parts."""
+    literals = []
+    run = []
+    for op, value in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(unichr(value))
+            continue
+        elif op == sre_parse.AT:
+            # Anchors do not match any character.
+            continue
+        elif op == sre_parse.SUBPATTERN:
+            literals.extend(regex_literals(value[-1]))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and value[0] >= 1:
+            literals.extend(regex_literals(value[2]))
+        literals.append(u''.join(run))
+        run = []
+    literals.append(u''.join(run))
+    return [literal for literal in literals if literal]
+
+
+def is_searchable_file(path, file_stat, authorizer):
+    """Check that the file can be searched, given its lstat."""
+    return (stat.S_ISREG(file_stat.st_mode) and file_stat.st_size <= setting('search_max_file_size') and
+            not authorizer.is_blacklisted(path))
+
+
+def read_searchable_file(path):
+    """Return the content of the file, or None if it is a binary file or too
+    big to be searched."""
+    max_size = setting('search_max_file_size')
+    with open(path, 'rb') as fp:
+        data = fp.read(max_size + 1)
+    if len(data) > max_size or '\0' in data[:BINARY_CHECK_SIZE]:
+        return None
+    return data
+
+
+def search_files(task):
+    """Search files, in a search process. The task is a (files, pattern,
+    literal, limit) tuple, files being (path, relative_path) pairs. Return the
+    (relative_path, matches) of the matching files, with at most limit matches
+    each."""
+    files, pattern, literal, limit = task
+    found = []
+    for path, relative_path in files:
+        try:
+            data = read_searchable_file(path)
+            if data is None or (literal is not None and literal not in data):
+                continue
+            content = data.decode('utf-8', 'replace')
+            if pattern.search(content) is None:
+                continue
+            matches = []
+            for line_number, line in enumerate(content.split(u'\n'), 1):
+                ranges = [[match.start(), match.end()] for match in pattern.finditer(line)
+                          if match.end() > match.start()]
+                if ranges:
+                    matches.append({'line': line_number, 'text': line.rstrip(u'\r')[:MAX_SEARCH_LINE_LENGTH],
+                                    'ranges': ranges})
+                    if len(matches) >= limit:
+                        break
+        except Exception:
+            # Nothing may escape, the serving process would wait for the
+            # result until the task times out.
+            continue
+        if matches:
+            found.append((relative_path, matches))
+    return found
+
+
+def index_files(files):
+    """Return the (relative_path, trigrams) of the files to index, (path,
+    relative_path) pairs, in a search process. The trigrams are concatenated,
+    and None if the file cannot be searched."""
+    indexed = []
+    for path, relative_path in files:
+        try:
+            data = read_searchable_file(path)
+        except Exception:
+            data = None
+        trigrams = None
+        if data is not None:
+            trigrams = ''.join(set(TRIGRAM.findall(data.lower())))
+        indexed.append((relative_path, trigrams))
+    return indexed
+
+
+def iter_batches(items, size):
+    """Generate the lists of size consecutive items."""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_pool(pool, function, tasks):
+    """Generate the function(task) computed by the search processes of pool,
+    or here if it is None, as they come.
+
+    Only a few tasks are queued at once, so that closing the generator spares
+    the tasks not queued yet. Raise OSError if a task times out, which
+    happens if a search process dies."""
+    if pool is None:
+        for task in tasks:
+            yield function(task)
+        return
+
+    window = 2 * setting('search_processes')
+    results = Queue.Queue()
+    queued = 0
+    tasks = iter(tasks)
+    while True:
+        for task in itertools.islice(tasks, window - queued):
+            pool.apply_async(function, (task,), callback=results.put)
+            queued += 1
+        if not queued:
+            return
+        try:
+            result = results.get(True, SEARCH_TASK_TIMEOUT)
+        except Queue.Empty:
+            raise OSError(errno.ETIMEDOUT, 'search task timed out')
+        queued -= 1
+        yield result
+
+
+def init_search_process():
+    """Leave the signals to the serving process, and close the sockets
+    inherited from it, so that they are not held open by the search processes
+    once closed by the server."""
+    # A search process killed while waiting for a task would leave the queue
+    # of the tasks locked, and the serving process stuck on exit. They exit
+    # with the pool instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if not os.path.isdir('/proc/self/fd'):
+        return
+    for name in os.listdir('/proc/self/fd'):
+        try:
+            if stat.S_ISSOCK(os.fstat(int(name)).st_mode):
+                os.close(int(name))
+        except OSError:
+            pass
+
+
+def make_search_pool():
+    """Return the pool of the search processes, or None if the files are
+    searched by the serving process."""
+    if setting('search_processes') <= 0:
+        return None
+    return multiprocessing.Pool(setting('search_processes'), init_search_process)
+
+
+def make_search_index():
+    """Return the SearchIndex of the served tree, or None if it is
+    disabled."""
+    if not setting('search_index'):
+        return None
+    return SearchIndex(PATH_AUTHORIZER.get(), EVENT_HUB.get(), IGNORE_MATCHER.get(), SEARCH_INDEX_FILENAME)
+
+
+SEARCH_POOL = ProcessLocal(make_search_pool)
+SEARCH_INDEX = ProcessLocal(make_search_index)
+
+
+class FileNameIndex(object):
+    """Index of the paths of the files of the served tree, for the fuzzy
+    matching of the find route.
+
+    The paths are held in a single string per directory, one path per line,
+    rather than in an object per file, so that big trees take little memory.
+    They are joined in a single table matched at once by a regular expression.
+    The paths matching the recent queries are kept too: as the user types,
+    the next query only has to be matched against them.
+
+    The index is built in the background on the first find, then kept up to
+    date from the changes reported by the event hub."""
+
+    # Seconds between two checks of the hub, when nothing changes.
+    WAIT_TIMEOUT = 3600
+
+    def __init__(self, authorizer, hub, ignore):
+        self.root = authorizer.root
+        self.authorizer = authorizer
+        self.hub = hub
+        self.ignore = ignore
+        # Relative directory paths to the relative paths of their files, one
+        # per line.
+        self.directories = {}
+        # All the paths, one per line, and the same lower-cased, built again
+        # after changes.
+        self.table = None
+        self.version = 0
+        # Tables of the paths matching the recent queries.
+        self.matches = SizedLRUCache(FIND_CACHE_SIZE)
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='glarkconnector-find')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        """Build the index, then apply the changes as they are published."""
+        self.hub.start()
+        since = self.hub.last_id()
+        self.rebuild()
+        self.ready.set()
+        while True:
+            events, since = self.hub.wait(since, self.WAIT_TIMEOUT)
+            events = [event for _, event in events]
+            if any(event['kind'] == 'reset' for event in events):
+                self.rebuild()
+                continue
+            # The new directories are scanned before locking the index.
+            scanned = dict((event['path'], self.scan(os.path.join(self.root, event['path'])))
+                           for event in events if event['kind'] == 'create' and event['type'] == 'dir')
+            with self.lock:
+                for event in events:
+                    self.apply(event, scanned)
+                self.table = None
+
+    def rebuild(self):
+        directories = self.scan(self.root)
+        with self.lock:
+            self.directories = directories
+            self.table = None
+
+    def scan(self, directory):
+        """Return the paths of the files under directory, a real path, by
+        relative directory."""
+        root = self.root.rstrip(os.sep) + os.sep
+        files = collections.defaultdict(list)
+        for path, _, file_stat in walk_tree(directory, self.authorizer, self.ignore):
+            if self.is_indexed(path, file_stat):
+                relative_path = path[len(root):]
+                files[os.path.dirname(relative_path)].append(relative_path)
+        return dict((relative_dir, '\n'.join(sorted(paths))) for relative_dir, paths in files.iteritems())
+
+    def is_indexed(self, path, file_stat):
+        name = os.path.basename(path)
+        return (stat.S_ISREG(file_stat.st_mode) and not self.authorizer.is_blacklisted(path) and
+                not STAGED_FILE_NAME.match(name) and '\n' not in name)
+
+    def apply(self, event, scanned):
+        """Apply a change to the index. Must be called with the lock held."""
+        relative_path = event['path']
+        if event['type'] == 'dir':
+            for relative_dir in [relative_dir for relative_dir in self.directories
+                                 if is_subpath(relative_dir, relative_path)]:
+                del self.directories[relative_dir]
+            self.directories.update(scanned.get(relative_path, {}))
+            return
+
+        path = os.path.join(self.root, relative_path)
+        if event['kind'] == 'delete':
+            self.update_directory(os.path.dirname(relative_path), removed=relative_path)
+        elif event['kind'] == 'create':
+            try:
+                file_stat = os.lstat(path)
+            except OSError:
+                return
+            if self.is_indexed(path, file_stat):
+                self.update_directory(os.path.dirname(relative_path), added=relative_path)
+
+    def update_directory(self, relative_dir, added=None, removed=None):
+        files = self.directories.get(relative_dir)
+        paths = set(files.split('\n')) if files else set()
+        if added is not None:
+            paths.add(added)
+        paths.discard(removed)
+        if paths:
+            self.directories[relative_dir] = '\n'.join(sorted(paths))
+        else:
+            self.directories.pop(relative_dir, None)
+
+    def find(self, query, limit):
+        """Return the paths matching query best, with the positions of the
+        matched characters, and whether there were too many matching paths
+        to rank them all."""
+        query = query.lower()
+        with self.lock:
+            if self.table is None:
+                table = '\n' + '\n'.join(self.directories.itervalues()) + '\n'
+                self.table = (table, table.lower())
+                self.version += 1
+            table, lowered = self.table
+            version = self.version
+
+        # The paths matching the query match its prefixes too.
+        for length in range(len(query) - 1, 0, -1):
+            matches = self.matches.get((version, query[:length]))
+            if matches is not None:
+                table, lowered = matches
+                break
+        paths = [table[match.start() + 1:match.end()]
+                 for match in make_fuzzy_pattern(query).finditer(lowered)]
+        matches = '\n' + '\n'.join(paths) + '\n'
+        self.matches.put((version, query), (matches, matches.lower()), 2 * len(matches))
+
+        ranked = []
+        for path in paths[:FIND_MAX_CANDIDATES]:
+            score, positions = score_path(query, path)
+            ranked.append((-score, len(path), path, positions))
+        best = heapq.nsmallest(limit, ranked)
+        return [(path, positions) for _, _, path, positions in best], len(paths) > FIND_MAX_CANDIDATES
+
+
+def make_fuzzy_pattern(query):
+    """Compile a regular expression matching the lines holding the characters
+    of query in order, with their leading newline.
+
+    Each character is looked for from the previous one on, up to its first
+    occurrence only, so that the lines not matching fail without
+    backtracking. Starting with a newline rather than a ^ lets the regular
+    expression engine skip to the next line quickly."""
+    parts = ['\n']
+    for char in query:
+        char = re.escape(char)
+        parts.append('[^%s\n]*%s' % (char, char))
+    parts.append('[^\n]*')
+    return re.compile(''.join(parts))
+
+
+# Characters starting a new word after them in a path.
+WORD_SEPARATORS = '/_-. '
+
+
+def score_path(query, path):
+    """Return the score of path for query, a lower-cased string it matches,
+    and the positions of the matched characters.
+
+    The characters are matched from the end, so that they fall in the file
+    name when they can. The characters following each other, starting words
+    or in the file name score more."""
+    lowered = path.lower()
+    positions = []
+    position = len(path)
+    for char in reversed(query):
+        position = lowered.rfind(char, 0, position)
+        positions.append(position)
+    positions.reverse()
+
+    name_start = path.rfind('/') + 1
+    score = 0
+    previous = None
+    for position in positions:
+        if previous is not None and position == previous + 1:
+            score += 4
+        if (position == 0 or path[position - 1] in WORD_SEPARATORS or
+                (path[position].isupper() and path[position - 1].islower())):
+            score += 3
+        if position >= name_start:
+            score += 2
+        previous = position
+    return score, positions
+
+
+def make_find_index():
+    """Return the FileNameIndex of the served tree, being built, or None if
+    it is disabled."""
+    if not setting('find_index'):
+        return None
+    index = FileNameIndex(PATH_AUTHORIZER.get(), EVENT_HUB.get(), IGNORE_MATCHER.get())
+    index.start()
+    return index
+
+
+FIND_INDEX = ProcessLocal(make_find_index)
+
+
+def make_parent_directories(path):
+    """Make the missing directories leading to path, which concurrent requests
+    may be making too. Return the directories made, outermost first."""
+    missing = []
+    directory = os.path.dirname(path)
+    while directory and not os.path.isdir(directory):
+        missing.append(directory)
+        directory = os.path.dirname(directory)
+    made = []
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(directory):
+                raise
+        else:
+            made.append(directory)
+    return made
+
+
+def write_file_atomically(path, chunks, fsync=False, replace=True):
+    """Write the chunks to a temporary file next to path, then move it to
+    path.
+
+    Readers see either the previous content of path or the new one, never a
+    partial one. If replace is False, fail with EEXIST instead of replacing an
+    existing path."""
+    temporary_path = stage_file(path, chunks, fsync)
+    try:
+        if replace:
+            os.rename(temporary_path, path)
+        else:
+            # Unlike rename, link does not overwrite an existing file.
+            os.link(temporary_path, path)
+            os.unlink(temporary_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+        raise
+
+    if fsync:
+        fsync_directory(os.path.dirname(path))
+
+
+# Names of the temporary files made by stage_file.
+STAGED_FILE_NAME = re.compile(r'\..+\.[a-z0-9_]{6}\.tmp\Z')
+
+
+def stage_file(path, chunks, fsync=False):
+    """Write the chunks to a temporary file next to path, with the
+    permissions of path, and return the path of the temporary file."""
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp',
+                                          prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+            fp.flush()
+            if fsync:
+                os.fsync(fp.fileno())
+
+        # mkstemp creates private files: give the permissions of the file
+        # being replaced, or the default ones.
+        try:
+            os.chmod(temporary_path, stat.S_IMODE(os.stat(path).st_mode))
+        except OSError:
+            os.chmod(temporary_path, 0o666 & ~UMASK)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    return temporary_path
+
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_content(content):
+    """Return the bytes to write for the content of a json body."""
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    return str(content)
+
+
+def apply_edits(content, edits):
+    """Return content with the edits applied.
+
+    Each edit replaces the characters of content from its 'start' to its
+    'end' (its start by default) by its 'text' (nothing by default). The edits
+    must not overlap. Raise ValueError if they cannot be applied."""
+    if not isinstance(edits, list):
+        raise ValueError('edits must be a list')
+    pieces = []
+    position = 0
+    for edit in sorted(edits, key=lambda edit: (edit['start'], edit.get('end', edit['start']))):
+        start = edit['start']
+        end = edit.get('end', start)
+        text = edit.get('text', u'')
+        if (not all(isinstance(offset, (int, long)) and not isinstance(offset, bool)
+                    for offset in (start, end)) or not isinstance(text, basestring)):
+            raise ValueError('invalid edit')
+        if not position <= start <= end <= len(content):
+            raise ValueError('edit out of bounds or overlapping another one')
+        pieces.append(content[position:start])
+        pieces.append(text)
+        position = end
+    pieces.append(content[position:])
+    return u''.join(pieces)
+
+
+HUNK_HEADER = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+def apply_unified_diff(content, diff):
+    """Return content patched with diff, a unified diff.
+
+    The hunks must apply exactly where they say: raise ValueError if one of
+    their context or removed lines does not match content."""
+    if not isinstance(diff, basestring):
+        raise ValueError('diff must be a string')
+    lines = content.splitlines(True)
+    diff_lines = diff.splitlines(True)
+    result = []
+    position = 0
+    index = 0
+    # Skip the file names.
+    while index < len(diff_lines) and not diff_lines[index].startswith('@@'):
+        index += 1
+
+    while index < len(diff_lines):
+        match = HUNK_HEADER.match(diff_lines[index])
+        if match is None:
+            raise ValueError('malformed hunk header')
+        index += 1
+        old_count = 1 if match.group(2) is None else int(match.group(2))
+        # An empty range starts after the given line.
+        start = int(match.group(1)) - 1 if old_count else int(match.group(1))
+        if start < position or start > len(lines):
+            raise ValueError('hunk out of order or out of bounds')
+        result.extend(lines[position:start])
+        position = start
+
+        previous_tag = None
+        while index < len(diff_lines) and not diff_lines[index].startswith('@@'):
+            line = diff_lines[index]
+            index += 1
+            tag, text = line[:1], line[1:]
+            if line in ('\n', '\r\n'):
+                # Some tools strip the space of the empty context lines.
+                tag, text = ' ', line
+            if tag == '\\':
+                # No newline at the end of the file, on the side of the
+                # previous line.
+                if previous_tag == '+':
+                    result[-1] = result[-1].rstrip('\r\n')
+                continue
+            elif tag in (' ', '-'):
+                if position >= len(lines) or lines[position].rstrip('\r\n') != text.rstrip('\r\n'):
+                    raise ValueError('line %d does not match' % (position + 1))
+                if tag == ' ':
+                    result.append(lines[position])
+                position += 1
+            elif tag == '+':
+                result.append(text)
+            else:
+                raise ValueError('malformed hunk line')
+            previous_tag = tag
+        if position - start != old_count:
+            raise ValueError('hunk length does not match its header')
+
+    result.extend(lines[position:])
+    return u''.join(result)
+
+
+class DirectoryLock(object):
+    """Exclusive lock on a directory, held against the other threads and the
+    other processes as well."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        # Closing the descriptor releases the lock.
+        os.close(self.fd)
+
+
+def fsync_directory(directory):
+    """Make the renamings in directory durable."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def make_etag(file_stat):
+    """Build the entity tag of the file described by file_stat.
+
+    The tag changes whenever the file is modified or replaced."""
+    return '"%x-%x-%x"' % (file_stat.st_ino, file_stat.st_size, int(file_stat.st_mtime * 1000000))
+
+
+def format_mtime(file_stat):
+    """Return the modification time of the file described by file_stat, as
+    sent to the clients: the shortest string giving back the exact float."""
+    return repr(file_stat.st_mtime)
+
+
+def mtime_matches(expected, file_stat):
+    """Is expected, a number or a string sent by a client, the exact
+    modification time of the file described by file_stat?"""
+    try:
+        return float(expected) == file_stat.st_mtime
+    except (TypeError, ValueError):
+        return False
+
+
+def etag_matches(if_none_match, etag):
+    """Does the If-None-Match header value designate etag?"""
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        # The compressed representations have their own tags, see
+        # send_content_headers.
+        for content_encoding in CONTENT_ENCODINGS:
+            if candidate.endswith('-' + content_encoding + '"'):
+                candidate = candidate[:-len(content_encoding) - 2] + '"'
+        if candidate == etag:
+            return True
+    return False
+
+
+def parse_http_date(value):
+    """Return the timestamp of an HTTP date, or None if it is not valid."""
+    if value is None:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    """Return the PBKDF2 HMAC-SHA256 key derived from password."""
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+    # Python before 2.7.8.
+    def prf(data):
+        return hmac.new(password, data, hashlib.sha256).digest()
+    block = prf(salt + struct.pack('>I', 1))
+    key = int(block.encode('hex'), 16)
+    for _ in range(iterations - 1):
+        block = prf(block)
+        key ^= int(block.encode('hex'), 16)
+    return ('%064x' % key).decode('hex')
+
+
+def make_authentication_hash(credentials, iterations=PBKDF2_ITERATIONS):
+    """Return the authentication_hash of the configuration for the given
+    'username:password' credentials, with a random salt."""
+    salt = base64.b64encode(os.urandom(16))
+    key = pbkdf2_sha256(credentials, salt, iterations)
+    return 'pbkdf2_sha256$%d$%s$%s' % (iterations, salt, base64.b64encode(key))
+
+
+def check_authorization(authorization):
+    """Does the Authorization header value match the credentials of the
+    configuration, its authentication_hash if set, else its
+    authentication_string?"""
+    if 'authentication_hash' in CONFIG:
+        try:
+            algorithm, iterations, salt, expected = CONFIG['authentication_hash'].encode('ascii').split('$')
+            if algorithm != 'pbkdf2_sha256':
+                return False
+            scheme, _, credentials = authorization.partition(' ')
+            if scheme.lower() != 'basic':
+                return False
+            key = pbkdf2_sha256(base64.b64decode(credentials), salt, int(iterations))
+        except (ValueError, TypeError, UnicodeError):
+            return False
+        return hmac.compare_digest(base64.b64encode(key), expected)
+
+    expected = CONFIG.get('authentication_string')
+    if expected is None:
+        return False
+    if isinstance(expected, unicode):
+        expected = expected.encode('utf-8')
+    return hmac.compare_digest(authorization, expected)
+
+
+def is_known_authorization(authorization):
+    """Was the Authorization header value found valid already?"""
+    # The headers themselves are not kept, only their digest.
+    return bool(AUTH_CACHE.get().get(hashlib.sha256(authorization).digest()))
+
+
+def remember_authorization(authorization):
+    AUTH_CACHE.get().put(hashlib.sha256(authorization).digest(), True, 1)
+
+
+def is_valid_authorization(authorization):
+    """Check the Authorization header value, remembering the valid ones so
+    that the hash of the credentials is computed only once."""
+    if authorization is None:
+        return False
+    if is_known_authorization(authorization):
+        return True
+    if not check_authorization(authorization):
+        return False
+    remember_authorization(authorization)
+    return True
+
+
+AUTH_CACHE = ProcessLocal(lambda: SizedLRUCache(AUTH_CACHE_SIZE))
+
+
+class FailureThrottle(object):
+    """Token buckets limiting the failures of each client: a client may fail
+    burst times in a row, then rate times per second. Only the max_clients
+    clients which failed last are remembered."""
+
+    def __init__(self, burst, rate, max_clients):
+        self.burst = burst
+        self.rate = rate
+        self.max_clients = max_clients
+        # The tokens of the clients, and when they were counted.
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def tokens(self, client, now):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            return self.burst
+        tokens, counted = bucket
+        return min(self.burst, tokens + (now - counted) * self.rate)
+
+    def retry_after(self, client):
+        """Return 0 if the client may try, else the seconds it should wait."""
+        now = time.time()
+        with self.lock:
+            tokens = self.tokens(client, now)
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def fail(self, client):
+        """Take a token from the bucket of the client."""
+        now = time.time()
+        with self.lock:
+            tokens = self.tokens(client, now)
+            self.buckets.pop(client, None)
+            self.buckets[client] = (max(0, tokens - 1), now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+
+
+AUTH_THROTTLE = ProcessLocal(lambda: FailureThrottle(setting('auth_failure_burst'),
+                                                     setting('auth_failure_rate'),
+                                                     AUTH_THROTTLE_MAX_CLIENTS))
+
+
+def session_secret():
+    """Return the key signing the session tokens: the session_secret of the
+    configuration, or one drawn when the connector starts."""
+    secret = CONFIG.get('session_secret')
+    if secret is None:
+        return SESSION_SECRET
+    return secret.encode('utf-8') if isinstance(secret, unicode) else secret
+
+
+# Shared by the forked processes, like the table of the revoked sessions.
+SESSION_SECRET = os.urandom(32)
+
+
+def sign_session(payload):
+    digest = hmac.new(session_secret(), payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip('=')
+
+
+def make_session_token(session_id, expires):
+    """Return the token of the session session_id, a hexadecimal string,
+    valid until the expires timestamp."""
+    payload = '%s.%d' % (session_id, expires)
+    return payload + '.' + sign_session(payload)
+
+
+def check_session_token(token):
+    """Return the (session id, expiry) of the token if it is a valid token of
+    a session still open, else None."""
+    payload, _, signature = token.rpartition('.')
+    session_id, _, expires = payload.partition('.')
+    if not hmac.compare_digest(signature, sign_session(payload)):
+        return None
+    try:
+        session_id, expires = session_id.decode('hex'), int(expires)
+    except (TypeError, ValueError):
+        return None
+    if len(session_id) != 16 or expires <= time.time() or REVOKED_SESSIONS.is_revoked(session_id):
+        return None
+    return session_id, expires
+
+
+class RevokedSessions(object):
+    """Table of the revoked sessions, kept until they expire, in an anonymous
+    shared memory map so that the processes forked after its creation share
+    it.
+
+    The table is made of capacity slots of a 16 bytes session id followed by
+    its expiry timestamp. Only the writers lock it: the expiry is written
+    before the id, so a reader finding an id always finds its expiry."""
+
+    SLOT = struct.Struct('16sQ')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.table = mmap.mmap(-1, capacity * self.SLOT.size)
+        self.lock = multiprocessing.Lock()
+
+    def find(self, session_id):
+        """Return the offset of the slot of session_id, or -1."""
+        offset = self.table.find(session_id)
+        while offset >= 0 and offset % self.SLOT.size:
+            offset = self.table.find(session_id, offset + 1)
+        return offset
+
+    def is_revoked(self, session_id):
+        offset = self.find(session_id)
+        if offset < 0:
+            return False
+        return self.SLOT.unpack_from(self.table, offset)[1] > time.time()
+
+    def revoke(self, session_id, expires):
+        """Revoke the session until it expires. Return False if the table is
+        full of sessions not expired yet."""
+        with self.lock:
+            if self.find(session_id) >= 0:
+                return True
+            now = time.time()
+            for offset in xrange(0, len(self.table), self.SLOT.size):
+                if self.SLOT.unpack_from(self.table, offset)[1] <= now:
+                    self.table[offset + 16:offset + self.SLOT.size] = self.SLOT.pack('', expires)[16:]
+                    self.table[offset:offset + 16] = session_id
+                    return True
+        return False
+
+
+REVOKED_SESSIONS = RevokedSessions(SESSION_MAX_REVOKED)
+
+
+def exist_conf_file():
+    return os.path.exists(CONFIGURATION_FILENAME)
+
+
+def setting(name):
+    """Return the value of the given setting, from the configuration if it is
+    set there, else its default value."""
+    return CONFIG.get(name, DEFAULT_SETTINGS[name])
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Connector for the glark.io editor.')
+    parser.add_argument('port', nargs='?', type=int, default=3000,
+                        help='port to listen on (default: 3000)')
+    parser.add_argument('--mode', dest='server_mode', choices=SERVER_MODES,
+                        help="concurrency model (default: '%s')" % DEFAULT_SETTINGS['server_mode'])
+    parser.add_argument('--workers', type=int,
+                        help='number of worker threads or processes (default: %d)' % DEFAULT_SETTINGS['workers'])
+    parser.add_argument('--max-in-flight', dest='max_in_flight', type=int,
+                        help='maximum number of requests being served or waiting (default: %d)'
+                        % DEFAULT_SETTINGS['max_in_flight'])
+    return parser.parse_args(argv)
+
+
+def make_server(port):
+    """Build the HTTP server matching the configured server mode."""
+    mode = setting('server_mode')
+    workers = max(1, setting('workers'))
+    max_in_flight = max(workers, setting('max_in_flight'))
+
+    if mode == 'single':
+        return BaseHTTPServer.HTTPServer(('', port), ConnectorRequestHandler)
+    elif mode == 'threaded':
+        return ThreadPoolHTTPServer(('', port), ConnectorRequestHandler, workers, max_in_flight)
+    elif mode == 'prefork':
+        if not hasattr(os, 'fork'):
+            raise ValueError("The 'prefork' mode is not available on this platform")
+        return PreforkHTTPServer(('', port), ConnectorRequestHandler, workers, max_in_flight)
+    elif mode == 'evented':
+        return EventedHTTPServer(('', port), ConnectorRequestHandler, workers, max_in_flight,
+                                 setting('idle_timeout'))
+    else:
+        raise ValueError("Unknown server mode '%s'" % mode)
+
+
+def startConnector(port):
+    httpd = make_server(port)
+
+    print('Connector v' + __version__ + ' serving directory:\n' + os.getcwd() + '\nat port ' + str(port) +
+          ' (' + setting('server_mode') + ' mode)')
+    httpd.serve_forever()
+
+
+def main():
+    global CONFIG
+    arguments = parse_arguments(sys.argv[1:])
+
+    # Greetings.
+    print(r"""
+            .__                __        .__
+       ____ |  | _____ _______|  | __    |__| ____
+      / ___\|  | \__  \\_  __ \  |/ /    |  |/  _ \
+     / /_/  >  |__/ __ \|  | \/    <     |  (  <_> )
+     \___  /|____(____  /__|  |__|_ \ /\ |__|\____/
+    /_____/           \/           \/ \/
+            """)
+
+    if exist_conf_file():
+        with open(CONFIGURATION_FILENAME) as fp:
+            CONFIG = json.load(fp)
+    else:
+        print("There is no '" + CONFIGURATION_FILENAME + "' configuration file in this directory yet.\n"
+                "This might be the first time that you glarkconnect this directory.\n"
+                "Please enter a username and password that will be required\n"
+                "to access this connector from the glark.io editor.\n"
+                "If you want to change these, simply delete the " + CONFIGURATION_FILENAME +
+                "\nthat will be created in this directory.")
+        username = raw_input('Username:')
+
+        ask_again = True
+        while ask_again:
+            password1 = getpass.getpass('Password:')
+            password2 = getpass.getpass('Re-enter Password:')
+            if password1 == password2:
+                ask_again = False
+            else:
+                print("Passwords do not match. Please try again.")
+
+        # Build the config object and dump it to config file. Only a salted
+        # hash of the credentials is kept.
+        CONFIG['authentication_hash'] = make_authentication_hash(username + ':' + password1)
+        # Keep the session tokens valid across restarts.
+        CONFIG['session_secret'] = base64.b64encode(os.urandom(32))
+
+        with open(CONFIGURATION_FILENAME, 'w') as fp:
+            json.dump(CONFIG, fp)
+
+    # Command line settings take precedence over the configuration file.
+    for name in ('server_mode', 'workers', 'max_in_flight'):
+        if getattr(arguments, name) is not None:
+            CONFIG[name] = getattr(arguments, name)
+
+    # Let a 'kill' shut the connector down as cleanly as a Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     try:
-        startConnector(port)
+        startConnector(arguments.port)
     except KeyboardInterrupt:
         print("\nShutting down glark connector.")
+    finally:
+        close_access_log()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,461 @@
+#!/usr/bin/python
+"""Load tests and benchmarks for the glarkconnector project.
+
+The connector is served in-process on an ephemeral port, over synthetic trees
+built in a temporary directory: no server needs to be running. Each workload
+is served by a forked copy of this process, so that its peak memory is its
+own. The results are written as JSON, and may be compared with the results of
+a previous run to catch the regressions:
+
+    python benchmark.py --output before.json
+    python benchmark.py --compare before.json"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import collections
+import httplib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import glarkconnector
+
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+AUTHORIZATION = 'Basic ' + base64.b64encode(USERNAME + ':' + PASSWORD)
+
+# Directory holding the files created by the 'post' workload.
+POSTED_DIRECTORY = 'posted'
+
+
+class Tree(object):
+    """Synthetic tree of files, of the given shape."""
+
+    def __init__(self, name, root):
+        self.name = name
+        self.root = root
+        self.files = []
+        self.directories = []
+        self.file_size = 0
+        self.contents = {}
+
+    def add_file(self, path, size):
+        full_path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as fp:
+            fp.write(make_text(size, len(self.files)))
+        self.files.append(path)
+        self.file_size = size
+
+    def content(self, i):
+        """Return one of a few contents as large as the files, for the
+        uploads."""
+        return self.contents.setdefault(i % 4, make_text(self.file_size, -1 - i % 4))
+
+    def finish(self):
+        self.directories = sorted(set(os.path.dirname(path) for path in self.files) - set(['']))
+
+
+def make_text(size, seed):
+    """Return size bytes of source-like text, different for each seed."""
+    generator = random.Random(seed)
+    words = ['def', 'return', 'self', 'value', 'import', 'class', 'for', 'in', 'if', 'else',
+             'glark', 'connector', 'file', 'path', '=', '(', ')', ':', '0', '1']
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(generator.choice(words) for _ in range(generator.randint(2, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def make_deep_tree(root, scale):
+    """A single chain of nested directories, with a few small files in each."""
+    tree = Tree('deep', root)
+    path = ''
+    for level in range(max(1, int(24 * scale))):
+        path = os.path.join(path, 'level%02d' % level)
+        for i in range(8):
+            tree.add_file(os.path.join(path, 'file%d.py' % i), 2 * 1024)
+    return tree
+
+
+def make_wide_tree(root, scale):
+    """A few directories holding a lot of small files each."""
+    tree = Tree('wide', root)
+    for directory in range(4):
+        for i in range(max(1, int(1000 * scale))):
+            tree.add_file(os.path.join('wide%d' % directory, 'file%04d.txt' % i), 512)
+    return tree
+
+
+def make_large_tree(root, scale):
+    """A few large files."""
+    tree = Tree('large', root)
+    for i in range(4):
+        tree.add_file(os.path.join('large', 'file%d.log' % i), max(1, int(1024 * 1024 * scale)))
+    return tree
+
+
+TREES = collections.OrderedDict([
+    ('deep', make_deep_tree),
+    ('wide', make_wide_tree),
+    ('large', make_large_tree),
+])
+
+
+# The workloads, each returning the method, path and body of its i-th request
+# on the given tree.
+
+def get_file_request(tree, i, run_id):
+    return 'GET', '/connector/files/' + tree.files[i % len(tree.files)], None
+
+
+def get_raw_request(tree, i, run_id):
+    return 'GET', '/connector/raw/' + tree.files[i % len(tree.files)], None
+
+
+def list_request(tree, i, run_id):
+    return 'GET', '/connector/files/' + tree.directories[i % len(tree.directories)], None
+
+
+def tree_request(tree, i, run_id):
+    return 'GET', '/connector/tree', None
+
+
+def put_request(tree, i, run_id):
+    body = json.dumps({'content': tree.content(i)})
+    return 'PUT', '/connector/files/' + tree.files[i % len(tree.files)], body
+
+
+def post_request(tree, i, run_id):
+    body = json.dumps({'content': tree.content(i)})
+    return 'POST', '/connector/files/%s/%s/file%d' % (POSTED_DIRECTORY, run_id, i), body
+
+
+WORKLOADS = collections.OrderedDict([
+    ('get_file', get_file_request),
+    ('get_raw', get_raw_request),
+    ('list', list_request),
+    ('tree', tree_request),
+    ('put', put_request),
+    ('post', post_request),
+])
+
+
+def peak_rss():
+    """Return the peak resident memory of this process and of its waited
+    children, in bytes."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux counts in kilobytes, OS X in bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def serve_tree(tree, settings, ready_fd):
+    """Serve the tree in this (forked) process until it is terminated, then
+    write the peak memory to ready_fd."""
+    os.chdir(tree.root)
+    glarkconnector.CONFIG = dict(settings, authentication_string=AUTHORIZATION)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    httpd = glarkconnector.make_server(0)
+
+    with os.fdopen(ready_fd, 'w') as fp:
+        fp.write(json.dumps({'port': httpd.server_address[1], 'rss': peak_rss()}) + '\n')
+        fp.flush()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        fp.write(json.dumps({'rss': peak_rss()}) + '\n')
+
+
+class ForkedServer(object):
+    """Connector serving a tree in a child process."""
+
+    def __init__(self, tree, settings, quiet=True):
+        read_fd, write_fd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(read_fd)
+                if quiet:
+                    null_fd = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(null_fd, 1)
+                    os.dup2(null_fd, 2)
+                serve_tree(tree, settings, write_fd)
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        self.output = os.fdopen(read_fd)
+        ready = self.read_message()
+        self.port = ready['port']
+        self.startup_rss = ready['rss']
+
+    def read_message(self):
+        line = self.output.readline()
+        if not line:
+            raise RuntimeError('The connector process exited')
+        return json.loads(line)
+
+    def stop(self):
+        """Stop the server, and return its peak memory."""
+        os.kill(self.pid, signal.SIGTERM)
+        try:
+            return self.read_message()['rss']
+        finally:
+            self.output.close()
+            os.waitpid(self.pid, 0)
+
+
+def run_workload(port, tree, make_request, count, concurrency, run_id):
+    """Send count requests from concurrency connections, and return the
+    latency of each request, the number of failed requests, the number of
+    bytes received and the elapsed time."""
+    latencies = []
+    failures = [0]
+    received = [0]
+    next_index = iter(range(count))
+    lock = threading.Lock()
+
+    def client():
+        connection = httplib.HTTPConnection('127.0.0.1', port)
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                break
+            method, path, body = make_request(tree, i, run_id)
+            headers = {'Authorization': AUTHORIZATION}
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            start = time.time()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                size = len(response.read())
+                ok = 200 <= response.status < 300
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                size = 0
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                received[0] += size
+                if not ok:
+                    failures[0] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures[0], received[0], time.time() - start
+
+
+def percentile(values, rank):
+    """Return the nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(rank / 100.0 * len(values))) - 1)]
+
+
+def run_forked(function, *args):
+    """Return the result of function(*args), run in a forked process so that
+    the memory it uses is not inherited by the next forked servers."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            with os.fdopen(write_fd, 'w') as fp:
+                json.dump(function(*args), fp)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        output = fp.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError('The benchmark process exited')
+    return json.loads(output)
+
+
+def benchmark(tree, workload, settings, arguments):
+    server = ForkedServer(tree, settings, quiet=not arguments.verbose)
+    try:
+        latencies, failures, received, duration = run_forked(
+            run_workload, server.port, tree, WORKLOADS[workload], arguments.requests,
+            arguments.concurrency, '%s-%d' % (workload, server.pid))
+    finally:
+        rss = server.stop()
+    latencies.sort()
+    return collections.OrderedDict([
+        ('tree', tree.name),
+        ('endpoint', workload),
+        ('requests', len(latencies)),
+        ('failures', failures),
+        ('duration', round(duration, 3)),
+        ('throughput', round(len(latencies) / duration, 1) if duration else None),
+        ('received_bytes', received),
+        ('latency_ms', collections.OrderedDict(
+            (name, round(value * 1000, 3) if value is not None else None) for name, value in [
+                ('mean', sum(latencies) / len(latencies) if latencies else None),
+                ('p50', percentile(latencies, 50)),
+                ('p99', percentile(latencies, 99)),
+                ('max', latencies[-1] if latencies else None)])),
+        ('startup_rss', server.startup_rss),
+        ('peak_rss', rss),
+    ])
+
+
+def compare(results, baseline, tolerance):
+    """Return the descriptions of the results worse than the baseline by more
+    than the tolerance."""
+    previous = dict(((result['tree'], result['endpoint']), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get((result['tree'], result['endpoint']))
+        if before is None:
+            continue
+        name = '%s/%s' % (result['tree'], result['endpoint'])
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f/s, was %.1f/s'
+                               % (name, result['throughput'], before['throughput']))
+        if result['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append('%s: p99 latency %.1f ms, was %.1f ms'
+                               % (name, result['latency_ms']['p99'], before['latency_ms']['p99']))
+        if result['peak_rss'] > before['peak_rss'] * (1 + tolerance):
+            regressions.append('%s: peak memory %.1f MB, was %.1f MB'
+                               % (name, result['peak_rss'] / 1e6, before['peak_rss'] / 1e6))
+        if result['failures'] > before['failures']:
+            regressions.append('%s: %d failed requests, was %d'
+                               % (name, result['failures'], before['failures']))
+    return regressions
+
+
+def parse_setting(value):
+    name, _, value = value.partition('=')
+    if name not in glarkconnector.DEFAULT_SETTINGS:
+        raise argparse.ArgumentTypeError("unknown setting '%s'" % name)
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def parse_list(choices):
+    def parse(value):
+        items = [item for item in value.split(',') if item]
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError("unknown '%s', choose from %s" % (item, ', '.join(choices)))
+        return items
+    return parse
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the glarkconnector.')
+    parser.add_argument('--trees', type=parse_list(TREES), default=list(TREES),
+                        help='comma separated trees to serve (default: %s)' % ','.join(TREES))
+    parser.add_argument('--workloads', type=parse_list(WORKLOADS), default=list(WORKLOADS),
+                        help='comma separated workloads to run (default: %s)' % ','.join(WORKLOADS))
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of requests of each workload (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent connections (default: 8)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='factor applied to the number and size of the files (default: 1)')
+    parser.add_argument('--mode', dest='server_mode', choices=glarkconnector.SERVER_MODES,
+                        help="concurrency model of the connector (default: '%s')"
+                        % glarkconnector.DEFAULT_SETTINGS['server_mode'])
+    parser.add_argument('--workers', type=int,
+                        help='number of worker threads or processes (default: %d)'
+                        % glarkconnector.DEFAULT_SETTINGS['workers'])
+    parser.add_argument('--set', dest='settings', metavar='NAME=VALUE', type=parse_setting,
+                        action='append', default=[], help='set a connector setting (JSON value)')
+    parser.add_argument('--output', help='file to write the JSON results to (default: standard output)')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='JSON results of a previous run, fail if these results are worse')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative difference tolerated by --compare (default: 0.2)')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the connector')
+    return parser.parse_args(argv)
+
+
+def main():
+    arguments = parse_arguments(sys.argv[1:])
+    settings = dict(arguments.settings)
+    for name in ('server_mode', 'workers'):
+        if getattr(arguments, name) is not None:
+            settings[name] = getattr(arguments, name)
+
+    results = []
+    root = tempfile.mkdtemp(prefix='glarkconnector-benchmark-')
+    try:
+        for name in arguments.trees:
+            tree_root = os.path.join(root, name)
+            os.mkdir(tree_root)
+            tree = TREES[name](tree_root, arguments.scale)
+            tree.finish()
+            for workload in arguments.workloads:
+                result = benchmark(tree, workload, settings, arguments)
+                results.append(result)
+                print('%-6s %-9s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  peak %7.1f MB  %d failed'
+                      % (name, workload, result['throughput'], result['latency_ms']['p50'],
+                         result['latency_ms']['p99'], result['peak_rss'] / 1e6, result['failures']),
+                      file=sys.stderr)
+                shutil.rmtree(os.path.join(tree_root, POSTED_DIRECTORY), ignore_errors=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = collections.OrderedDict([
+        ('version', glarkconnector.__version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.sysconf('SC_NPROCESSORS_ONLN')),
+        ('settings', collections.OrderedDict([
+            ('requests', arguments.requests),
+            ('concurrency', arguments.concurrency),
+            ('scale', arguments.scale),
+            ('connector', settings)])),
+        ('results', results),
+    ])
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if arguments.compare:
+        with open(arguments.compare) as fp:
+            regressions = compare(results, json.load(fp), arguments.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()